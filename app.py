@@ -1,57 +1,329 @@
 # Import Libraries
+# Only the libraries of the inference path are imported here. pandas and matplotlib are imported on
+# first use, sklearn when a pickled model is loaded.
 # ================================================================================================
-from flask import Flask, redirect, request,  url_for, render_template,Response
+import time
+_IMPORT_START = time.perf_counter()
+
+from flask import Flask, redirect, request,  url_for, render_template,Response, jsonify, send_from_directory
 import numpy as np
-from matplotlib import pyplot as plt
 import cv2 as cv
-import statistics
-import pandas as pd
-
-from sklearn import svm
-from sklearn.model_selection import train_test_split
-from sklearn.svm import SVC
-from sklearn.metrics import classification_report, confusion_matrix
 
 import warnings
 warnings.filterwarnings('ignore')
 import pickle
 import os
+import hashlib
+import hmac
+import io
+import json
+import shutil
+import threading
+import queue
+import uuid
+import logging
+import functools
+import itertools
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
 from werkzeug.utils import secure_filename
 
+# Section 0
+# Logging and Metrics
+# ====================================================================================================
+# Debug output (cluster features, feature sets, per-request details) is logged at DEBUG level and
+# costs nothing unless LOG_LEVEL=DEBUG.
+# ----------------------------------------------------------------------------------------------------
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'WARNING').upper()
+LOG_FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+logger = logging.getLogger('plant_disease')
+logger.setLevel(LOG_LEVEL)
+
+# ====================================================================================================
+# Prometheus Metrics
+# Counters and histograms kept in process memory and exposed in the Prometheus text format on
+# /metrics. Each metric is declared once in METRICS with its type, help text and (for histograms)
+# bucket bounds; samples are keyed by their label values.
+# Every sample carries a worker_pid label: under a pre-forking server (serve.py) each worker process
+# keeps and reports its own values, and a scrape reaches one worker at a time. Sum over worker_pid
+# (and scrape every worker, e.g. one port per worker) for process-wide totals.
+# ----------------------------------------------------------------------------------------------------
+STAGE_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+MEGAPIXEL_BUCKETS = (0.1, 0.3, 1.0, 2.0, 4.0, 8.0, 12.0, 24.0, 50.0, 100.0)
+
+METRICS = {
+    'plant_stage_seconds': ('histogram', 'Time spent in each pipeline stage', STAGE_BUCKETS),
+    'plant_image_megapixels': ('histogram', 'Size of the processed images in megapixels', MEGAPIXEL_BUCKETS),
+    'plant_requests_total': ('counter', 'HTTP requests by endpoint and status code', None),
+    'plant_labels_total': ('counter', 'Classified images by label', None),
+    'plant_prescreen_total': ('counter', 'Thumbnail pre-screens by outcome (negative or escalated)', None),
+    'plant_profiles_total': ('counter', 'Profiled submissions by trigger (header or rate), busy when skipped', None),
+}
+
+_METRICS_LOCK = threading.Lock()
+_METRIC_SAMPLES = {name: {} for name in METRICS}
+# Threads with suppressed set (e.g. the startup warm-up) record no samples
+_METRICS_LOCAL = threading.local()
+
+def inc_metric(name, value=1, **labels):
+    if getattr(_METRICS_LOCAL, 'suppressed', False):
+        return
+    key = tuple(sorted(labels.items()))
+    with _METRICS_LOCK:
+        samples = _METRIC_SAMPLES[name]
+        samples[key] = samples.get(key, 0) + value
+
+def observe_metric(name, value, **labels):
+    if getattr(_METRICS_LOCAL, 'suppressed', False):
+        return
+    key = tuple(sorted(labels.items()))
+    buckets = METRICS[name][2]
+    with _METRICS_LOCK:
+        sample = _METRIC_SAMPLES[name].get(key)
+        if sample is None:
+            sample = _METRIC_SAMPLES[name][key] = {'buckets': [0] * len(buckets), 'sum': 0.0, 'count': 0}
+        for idx, bound in enumerate(buckets):
+            if value <= bound:
+                sample['buckets'][idx] += 1
+        sample['sum'] += value
+        sample['count'] += 1
+
+# ====================================================================================================
+# Decorator recording the run time of a pipeline stage in plant_stage_seconds
+# ----------------------------------------------------------------------------------------------------
+def timed_stage(stage):
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                observe_metric('plant_stage_seconds', time.perf_counter() - start, stage=stage)
+        return wrapper
+    return decorator
+
+def _format_labels(labels, extra=()):
+    pairs = list(labels) + list(extra)
+    if not pairs:
+        return ''
+    escaped = []
+    for key, value in pairs:
+        value = str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+        escaped.append(key + '="' + value + '"')
+
+    return '{' + ','.join(escaped) + '}'
+
+def render_metrics(gauges=()):
+    pid = [('worker_pid', os.getpid())]
+    lines = []
+    with _METRICS_LOCK:
+        for name, (metric_type, help_text, buckets) in METRICS.items():
+            lines.append('# HELP ' + name + ' ' + help_text)
+            lines.append('# TYPE ' + name + ' ' + metric_type)
+            for labels, sample in sorted(_METRIC_SAMPLES[name].items()):
+                if metric_type == 'counter':
+                    lines.append(name + _format_labels(labels, pid) + ' ' + repr(float(sample)))
+                    continue
+                for bound, count in zip(buckets, sample['buckets']):
+                    lines.append(name + '_bucket' + _format_labels(labels, pid + [('le', repr(float(bound)))]) + ' ' + str(count))
+                lines.append(name + '_bucket' + _format_labels(labels, pid + [('le', '+Inf')]) + ' ' + str(sample['count']))
+                lines.append(name + '_sum' + _format_labels(labels, pid) + ' ' + repr(sample['sum']))
+                lines.append(name + '_count' + _format_labels(labels, pid) + ' ' + str(sample['count']))
+    # Point-in-time values: (name, help text, value)
+    for name, help_text, value in gauges:
+        lines.append('# HELP ' + name + ' ' + help_text)
+        lines.append('# TYPE ' + name + ' gauge')
+        lines.append(name + _format_labels((), pid) + ' ' + repr(float(value)))
+
+    return '\n'.join(lines) + '\n'
+
+# ====================================================================================================
+# Buffer Pool
+# Full-size working arrays of the pipeline (HSV image, K-Means input and labels, nearest-center
+# distances, segmented image, masks, enhanced planes, ROI and render canvas) are taken from a pool of
+# reused buffers and written through out= parameters instead of being allocated for every request.
+# One pool per process keeps the idle buffers, by name, shape and dtype. A pipeline run checks the
+# buffers it needs out of the pool through a BufferLease and returns them when it is done, so
+# concurrent request threads never share a buffer. The pool keeps at most BUFFER_POOL_MAX_BYTES of
+# idle buffers for the whole process (buffers in use belong to their run, as without pooling). When a
+# run returns its buffers, the buffers of shapes no run used in the last BUFFER_POOL_KEEP_RUNS runs
+# are dropped (e.g. after a large image), then the least recently returned ones beyond the cap.
+# The default cap holds the working arrays of one 6 MP run; larger images reuse what fits.
+# BUFFER_POOL=0 disables pooling.
+# Only runs whose arrays do not outlive the request use a lease: analyze_image(), run_submission()
+# (detect -> render) and detect(pool=...). A plain detect() allocates its arrays as before.
+# ----------------------------------------------------------------------------------------------------
+BUFFER_POOL = os.environ.get('BUFFER_POOL', '1') == '1'
+BUFFER_POOL_MAX_BYTES = int(os.environ.get('BUFFER_POOL_MAX_BYTES', 256 << 20))
+BUFFER_POOL_KEEP_RUNS = int(os.environ.get('BUFFER_POOL_KEEP_RUNS', 8))
+
+class BufferPool(object):
+    def __init__(self, max_bytes=None, keep_runs=None):
+        self.max_bytes = BUFFER_POOL_MAX_BYTES if max_bytes is None else max_bytes
+        self.keep_runs = BUFFER_POOL_KEEP_RUNS if keep_runs is None else keep_runs
+        self.nbytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.reused_bytes = 0
+        self.dropped_bytes = 0
+        self.runs = 0
+        # key -> idle buffers of the key, least recently returned key first; key -> run that last returned it
+        self._idle = OrderedDict()
+        self._last_run = {}
+        self._lock = threading.Lock()
+
+    # An idle buffer of the key (name, shape, dtype), None when the pool has none
+    def checkout(self, key):
+        with self._lock:
+            buffers = self._idle.get(key)
+            if not buffers:
+                self.misses += 1
+                return None
+            buf = buffers.pop()
+            if not buffers:
+                del self._idle[key]
+                del self._last_run[key]
+            self.nbytes -= buf.nbytes
+            self.hits += 1
+            self.reused_bytes += buf.nbytes
+
+        return buf
+
+    # Take back the (key, buffer) pairs of a finished run
+    def checkin(self, buffers):
+        with self._lock:
+            self.runs += 1
+            for key, buf in buffers:
+                if buf.nbytes > self.max_bytes:
+                    continue
+                self._idle.setdefault(key, []).append(buf)
+                self._idle.move_to_end(key)
+                self._last_run[key] = self.runs
+                self.nbytes += buf.nbytes
+            # Oldest keys first: drop the stale ones, then the ones beyond the cap
+            for key in list(self._idle):
+                if self.runs - self._last_run[key] < self.keep_runs and self.nbytes <= self.max_bytes:
+                    break
+                for buf in self._idle.pop(key):
+                    self.nbytes -= buf.nbytes
+                    self.dropped_bytes += buf.nbytes
+                del self._last_run[key]
+
+    def clear(self):
+        with self._lock:
+            self._idle.clear()
+            self._last_run.clear()
+            self.nbytes = 0
+
+    def stats(self):
+        with self._lock:
+            return {'buffers': sum(len(buffers) for buffers in self._idle.values()), 'bytes': self.nbytes, 'hits': self.hits,
+                    'misses': self.misses, 'reused_bytes': self.reused_bytes, 'dropped_bytes': self.dropped_bytes,
+                    'max_bytes': self.max_bytes}
+
+# Buffers of one pipeline run: get() returns the same buffer for the same name, shape and dtype until
+# release() returns them all to the pool
+class BufferLease(object):
+    def __init__(self, pool):
+        self.pool = pool
+        self._buffers = OrderedDict()
+
+    # Buffer of the given name, shape and dtype with undefined contents
+    def get(self, name, shape, dtype=np.uint8):
+        key = (name, tuple(shape), np.dtype(dtype).str)
+        buf = self._buffers.get(key)
+        if buf is None:
+            buf = self.pool.checkout(key)
+            if buf is None:
+                buf = np.empty(shape, dtype=dtype)
+            self._buffers[key] = buf
+
+        return buf
+
+    def release(self):
+        buffers = list(self._buffers.items())
+        self._buffers.clear()
+        self.pool.checkin(buffers)
+
+_BUFFER_POOL = BufferPool()
+
+# Lease on the process buffer pool for one run, None with BUFFER_POOL=0
+def lease_buffers():
+    if not BUFFER_POOL:
+        return None
+
+    return BufferLease(_BUFFER_POOL)
+
+def buffer_pool_stats():
+    return _BUFFER_POOL.stats()
+
 # Section 1
 # ML Codes
 # ====================================================================================================
 # Enhancement Process
+# CLAHE only works on single-channel images, so the channels are still equalized one by one, but the
+# CLAHE object is created once per thread and reused (an instance keeps internal buffers and must not
+# be shared between threads). With swap_rb the channels are merged in reverse order, so a decoded BGR
+# image is enhanced straight into an RGB result without a separate colour conversion. The result is
+# written into out and the channel planes are taken from pool when given (see Buffer Pool).
 # ----------------------------------------------------------------------------------------------------
-def enhancement(inp_img):
+_CLAHE_LOCAL = threading.local()
 
-    # Input Image Channel
-    r_chnl_img = inp_img[:,:,0]
-    g_chnl_img = inp_img[:,:,1]
-    b_chnl_img = inp_img[:,:,2]
+def get_clahe():
+    clahe = getattr(_CLAHE_LOCAL, 'clahe', None)
+    if clahe is None:
+        clahe = _CLAHE_LOCAL.clahe = cv.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
+
+    return clahe
+
+@timed_stage('enhancement')
+def enhancement(inp_img, swap_rb=False, out=None, pool=None):
+
+    # Input Image Channel (contiguous planes)
+    if pool is not None:
+        chnl_imgs = [cv.extractChannel(inp_img, idc, dst=pool.get('enhancement_plane_%d' % idc, inp_img.shape[:2])) for idc in range(3)]
+    else:
+        chnl_imgs = cv.split(inp_img)
 
     # ------------------------------------------------------------------------------------------------
     # Method: Applying CLAHE (Contrast Limited Adaptive Histogram Equalization)
     # Image is divided into small blocks (8x8) applied for histogram equalization. Contrast limiting is applied 
     # to avoid noise based on comparing histogram bin with specified contrast limit (default is 40) 
     # ------------------------------------------------------------------------------------------------
-    clahe = cv.createCLAHE(clipLimit=2.0, tileGridSize=(8,8))
-    r_enh_img = clahe.apply(r_chnl_img)
-    g_enh_img = clahe.apply(g_chnl_img)
-    b_enh_img = clahe.apply(b_chnl_img)
+    clahe = get_clahe()
+    for chnl_img in chnl_imgs:
+        clahe.apply(chnl_img, dst=chnl_img)
 
     # ------------------------------------------------------------------------------------------------
     # Combining enhanced channels
-    enh_img = cv.merge((r_enh_img, g_enh_img, b_enh_img))
+    enh_img = cv.merge(chnl_imgs[::-1] if swap_rb else chnl_imgs, dst=out)
 
     #plt.imshow(enh_img)
   
     return enh_img
 
+# Number of K-Means clusters used by segmentation_process
+NO_OF_CLUSTER = 5
+
+# Segmentation mode: 'full' clusters every pixel, 'fast' fits the centers on a random sample of
+# FAST_SAMPLE_SIZE pixels and assigns every pixel to its nearest center afterwards
+SEGMENTATION_MODE = os.environ.get('SEGMENTATION_MODE', 'full')
+FAST_SAMPLE_SIZE = 50000
+FAST_ITERATION = 5
+
 # ====================================================================================================
 # Segmentation Process 
+# A seed makes the K-Means initialization deterministic (OpenCV's RNG is seeded before clustering).
+# With init_centers (e.g. the centers of the previous video frame) K-Means is warm-started from the
+# nearest-center labels of those centers and runs a single attempt. With return_centers the fitted
+# centers (K x 3, float32) are returned as well. The segmented image is written into out, the K-Means
+# input and labels are taken from pool when given (see Buffer Pool).
 # ----------------------------------------------------------------------------------------------------
-def segmentation_process(inp_img):
+@timed_stage('segmentation')
+def segmentation_process(inp_img, mode=None, seed=None, init_centers=None, return_centers=False, out=None, pool=None):
+    if (mode or SEGMENTATION_MODE) == 'fast':
+        return fast_segmentation_process(inp_img, seed=seed, init_centers=init_centers, return_centers=return_centers, out=out, pool=pool)
     
     # Criteria Setting for K-Means Clustering
     # ------------------------------------------------------------------------------------------------
@@ -62,39 +334,169 @@ def segmentation_process(inp_img):
 
     # Reshaping the input image into a 2D array of pixels and 3 chanels
     reshaped_img = inp_img.reshape((-1,3))
-    reshaped_inp_img = np.float32(reshaped_img)
+    if pool is not None:
+        reshaped_inp_img = pool.get('kmeans_input', reshaped_img.shape, np.float32)
+        np.copyto(reshaped_inp_img, reshaped_img)
+    else:
+        reshaped_inp_img = np.float32(reshaped_img)
 
     # Parameters
-    no_of_cluster = [5]
+    no_of_cluster = [NO_OF_CLUSTER]
     iteration = [15]
 
     # Experiment 1:
     # --------------------------------------------------------------------
-    retval, labels_1, centers = cv.kmeans(reshaped_inp_img, no_of_cluster[0], None, criteria, iteration[0], cv.KMEANS_RANDOM_CENTERS)
+    if seed is not None:
+        cv.setRNGSeed(seed)
+    if init_centers is not None:
+        init_labels = assign_labels(reshaped_img, init_centers)
+        retval, labels_1, centers = cv.kmeans(reshaped_inp_img, no_of_cluster[0], init_labels, criteria, 1, cv.KMEANS_USE_INITIAL_LABELS)
+    else:
+        best_labels = pool.get('labels', (reshaped_img.shape[0], 1), np.int32) if pool is not None else None
+        retval, labels_1, centers = cv.kmeans(reshaped_inp_img, no_of_cluster[0], best_labels, criteria, iteration[0], cv.KMEANS_RANDOM_CENTERS)
+    fit_center = centers
     # convert data into 8-bit values
     centers = np.uint8(centers)
-    segmented_dt_1 = centers[labels_1.flatten()]
-    # reshape data into the original image dimensions
-    segmented_img_1 = segmented_dt_1.reshape((inp_img.shape))
+    segmented_img_1 = segment_image(centers, labels_1, inp_img.shape, out=out)
+
+    if return_centers:
+        return segmented_img_1, labels_1, fit_center
 
     return segmented_img_1, labels_1
 
+# ====================================================================================================
+# Segmented image: the (uint8) center colour of every pixel's label, written into out when given
+# i/p: centers (K x 3, uint8), labels (N x 1), shape (H, W, 3), o/p: segmented image (H x W x 3)
+# ----------------------------------------------------------------------------------------------------
+def segment_image(centers, labels, shape, out=None):
+    if out is None:
+        return centers[labels.ravel()].reshape(shape)
+
+    # mode='clip' writes straight into out (the default mode buffers it); labels are valid indices
+    np.take(centers, labels.ravel(), axis=0, out=out.reshape(-1, 3), mode='clip')
+    return out
+
+# ====================================================================================================
+# Nearest-center label of every pixel, computed in chunks to bound the (chunk x K) distance matrix
+# The labels are written into out, the per-chunk float32 pixels and distances are taken from pool
+# when given (see Buffer Pool).
+# i/p: pixels (N x 3), centers (K x 3), o/p: labels (N x 1, int32 as returned by cv.kmeans)
+# ----------------------------------------------------------------------------------------------------
+def assign_labels(pixels, centers, chunk_size=1 << 20, out=None, pool=None):
+    centers = np.float32(centers)
+    # |x - c|^2 = |x|^2 - 2 x.c + |c|^2, where |x|^2 is the same for every center
+    centers_sq = (centers ** 2).sum(axis=1)
+    labels = out if out is not None else np.empty((pixels.shape[0], 1), dtype=np.int32)
+    rows = min(chunk_size, pixels.shape[0])
+    if pool is not None:
+        chunk_buf = pool.get('assign_chunk', (rows, 3), np.float32)
+        dist_buf = pool.get('assign_dist', (rows, centers.shape[0]), np.float32)
+        nearest_buf = pool.get('assign_nearest', (rows,), np.intp)
+    for start in range(0, pixels.shape[0], chunk_size):
+        block = pixels[start:start + chunk_size]
+        if pool is not None:
+            chunk = chunk_buf[:block.shape[0]]
+            np.copyto(chunk, block)
+            dist = np.matmul(chunk, centers.T, out=dist_buf[:block.shape[0]])
+        else:
+            chunk = np.float32(block)
+            dist = chunk @ centers.T
+        dist *= -2
+        dist += centers_sq
+        labels[start:start + chunk_size, 0] = dist.argmin(axis=1, out=nearest_buf[:block.shape[0]] if pool is not None else None)
+
+    return labels
+
+# ====================================================================================================
+# Random sample of at most sample_size pixels (all pixels when there are fewer)
+# i/p: pixels (N x 3), o/p: sample (n x 3)
+# ----------------------------------------------------------------------------------------------------
+def sample_pixels(pixels, sample_size=None, seed=None):
+    sample_size = sample_size or FAST_SAMPLE_SIZE
+    if pixels.shape[0] <= sample_size:
+        return pixels
+
+    rng = np.random.default_rng(seed)
+    # sorted indices read a memory-mapped raster front to back
+    return pixels[np.sort(rng.choice(pixels.shape[0], sample_size, replace=False))]
+
+# ====================================================================================================
+# K-Means centers of a pixel sample (k-means++ initialization, FAST_ITERATION attempts), or a single
+# attempt warm-started from the nearest-center labels of init_centers
+# i/p: sample (n x 3), o/p: centers (K x 3, float32)
+# ----------------------------------------------------------------------------------------------------
+def fit_centers(sample, seed=None, init_centers=None):
+    criteria = (cv.TERM_CRITERIA_EPS + cv.TERM_CRITERIA_MAX_ITER, 100, 0.85)
+    if seed is not None:
+        cv.setRNGSeed(seed)
+    if init_centers is not None:
+        init_labels = assign_labels(sample, init_centers)
+        retval, sample_labels, centers = cv.kmeans(np.float32(sample), NO_OF_CLUSTER, init_labels, criteria, 1, cv.KMEANS_USE_INITIAL_LABELS)
+    else:
+        retval, sample_labels, centers = cv.kmeans(np.float32(sample), NO_OF_CLUSTER, None, criteria, FAST_ITERATION, cv.KMEANS_PP_CENTERS)
+
+    return centers
+
+# ====================================================================================================
+# Fast Segmentation Process
+# The K-Means centers are fitted on a random pixel sample and the full-resolution labels are assigned
+# in one vectorized nearest-center pass.
+# ----------------------------------------------------------------------------------------------------
+def fast_segmentation_process(inp_img, seed=None, sample_size=None, init_centers=None, return_centers=False, out=None, pool=None):
+    reshaped_img = inp_img.reshape((-1,3))
+    fit_center = fit_centers(sample_pixels(reshaped_img, sample_size, seed), seed, init_centers=init_centers)
+
+    labels_buf = pool.get('labels', (reshaped_img.shape[0], 1), np.int32) if pool is not None else None
+    labels = assign_labels(reshaped_img, fit_center, out=labels_buf, pool=pool)
+    # convert data into 8-bit values
+    centers = np.uint8(fit_center)
+    segmented_img = segment_image(centers, labels, inp_img.shape, out=out)
+
+    if return_centers:
+        return segmented_img, labels, fit_center
+
+    return segmented_img, labels
+
+# ====================================================================================================
+# Decode an encoded image (JPEG, PNG, ..) held in memory into a BGR image without touching the disk
+# i/p: bytes, bytearray, memoryview or 1-D uint8 array, o/p: BGR uint8 image
+# ----------------------------------------------------------------------------------------------------
+def decode_image(data):
+    buf = data if isinstance(data, np.ndarray) else np.frombuffer(data, dtype=np.uint8)
+    inp_img = cv.imdecode(buf, cv.IMREAD_COLOR) if buf.size > 0 else None
+    if inp_img is None:
+        raise ValueError('could not decode the image data')
+
+    return inp_img
+
+# ====================================================================================================
+# Read the input of process(): an image path, an encoded in-memory buffer (bytes-like, 1-D uint8
+# array or a file-like object) or an already decoded BGR image
+# ----------------------------------------------------------------------------------------------------
+def read_image(inp_img):
+    if isinstance(inp_img, str):
+        img = cv.imread(inp_img)
+        if img is None:
+            raise ValueError('could not read the image ' + inp_img)
+        return img
+    if isinstance(inp_img, np.ndarray) and inp_img.ndim == 3:
+        return inp_img
+    if hasattr(inp_img, 'read'):
+        inp_img = inp_img.read()
+
+    return decode_image(inp_img)
+
 # ====================================================================================================
 # Function can perform pre-processing, segmentation to detect ROI
+# The HSV image is converted straight from the decoded BGR buffer: COLOR_RGB2HSV on BGR data gives
+# the same result as the original BGR -> RGB -> (COLOR_BGR2HSV) chain without the intermediate copy.
+# Runs the enhancement and segmentation stages of PipelineStages (see Lazy Pipeline Stages).
 # ----------------------------------------------------------------------------------------------------
-def process(inp_img_path):
-    # Read the Image
-    inp_img = cv.imread(inp_img_path)
-    # Change color to RGB (from BGR)
-    inp_img_cmap = cv.cvtColor(inp_img, cv.COLOR_BGR2RGB)
-    # Enhanced Image
-    enh_img = enhancement(inp_img_cmap)
-    # Convert RGB Color to HSV Color Model
-    hsv_cmap = cv.cvtColor(inp_img_cmap, cv.COLOR_BGR2HSV)
-    # Segmented Image
-    seg_hsv_clas, seg_hsv_lbl = segmentation_process(hsv_cmap)
+def process(inp_img_path, seg_mode=None):
+    stages = PipelineStages(inp_img_path, seg_mode=seg_mode)
+    seg_hsv_clas, seg_hsv_lbl = stages['segmentation']
 
-    return enh_img, seg_hsv_clas, seg_hsv_lbl
+    return stages['enhancement'], seg_hsv_clas, seg_hsv_lbl
 
 # ====================================================================================================
 # Create Train Model : HSI Disease/Non-Disease Segmented Color Features Set 
@@ -309,193 +711,525 @@ FEATURE_SET_EXPLORED = [
 
 ]
 
-# feature_df 
-FEATURE_EXPL_DF = pd.DataFrame(FEATURE_SET_EXPLORED, columns=['feature_1', 'feature_2', 'feature_3', 'label'])
-
-# feature_mid_expl_df
-FEATURE_MID_EXPL_DF = pd.DataFrame(FEATURE_SET_MID_EXPL, columns=['feature_1', 'feature_2', 'feature_3', 'label'])
+# ====================================================================================================
+# Training DataFrames, built on first access (app.FEATURE_EXPL_DF, from app import FEATURE_EXPL_DF)
+# since the inference path does not use them:
+#   FEATURE_EXPL_DF (feature_df), FEATURE_MID_EXPL_DF (feature_mid_expl_df),
+#   FEATURE_BEGN_DF (feature_begin_df)
+# ----------------------------------------------------------------------------------------------------
+_FEATURE_DF_SETS = {
+    'FEATURE_EXPL_DF': FEATURE_SET_EXPLORED,
+    'FEATURE_MID_EXPL_DF': FEATURE_SET_MID_EXPL,
+    'FEATURE_BEGN_DF': FEATURE_SET_BEGIN,
+}
 
-# feature_begin_df
-FEATURE_BEGN_DF = pd.DataFrame(FEATURE_SET_BEGIN, columns=['feature_1', 'feature_2', 'feature_3', 'label'])
+def __getattr__(name):
+    if name in _FEATURE_DF_SETS:
+        import pandas as pd
+        feature_df = pd.DataFrame(_FEATURE_DF_SETS[name], columns=['feature_1', 'feature_2', 'feature_3', 'label'])
+        globals()[name] = feature_df
+        return feature_df
+    raise AttributeError("module " + repr(__name__) + " has no attribute " + repr(name))
 
 
 # ====================================================================================================
 # Extraction of Disease/Non-Disease Segmented Color Features based on selected label
+# The per-cluster comparison is written into a buffer of pool when given (see Buffer Pool).
 # ----------------------------------------------------------------------------------------------------
-def get_segmented_features_set(seg_img, seg_lbl):
-    seg_label = seg_lbl.reshape(seg_img.shape[0],seg_img.shape[1])
-    clstr = np.arange(0,5)
+def get_segmented_features_set(seg_img, seg_lbl, pool=None):
+    seg_label = seg_lbl.ravel()
+    seg_pixels = seg_img.reshape(-1, 3)
     f_set = []
     #print('HSI Disease/Non-Disease Segmented Color Features')
-    for idz in range(len(clstr)):
-        count = 1
-        for idx in range(seg_label.shape[0]):
-            for idy in range(seg_label.shape[1]):
-                if (int(seg_label[idx][idy]) == int(clstr[idz])) and (count == 1):
-                    f_set.append([int(seg_img[idx,idy,0]), int(seg_img[idx,idy,1]), int(seg_img[idx,idy,2])])
-                    print('Cluster: ' + str(clstr[idz]) + ' - Features: ' + str(int(seg_img[idx,idy,0])) + ' ' + str(int(seg_img[idx,idy,1])) + ' ' + str(int(seg_img[idx,idy,2])))
-                    #print(str(int(seg_img[idx,idy,0])) + ' ' + str(int(seg_img[idx,idy,1])) + ' ' + str(int(seg_img[idx,idy,2])))
-                    count = count + 1
-                    continue
-                    
+    # ------------------------------------------------------------------------------------------------
+    # The representative feature of a cluster is the segmented colour of its first pixel (row-major),
+    # located with one vectorized comparison per cluster instead of a Python loop over every pixel.
+    # Clusters without any pixel are skipped.
+    # ------------------------------------------------------------------------------------------------
+    hits_buf = pool.get('cluster_hits', seg_label.shape, bool) if pool is not None else None
+    for clstr in range(NO_OF_CLUSTER):
+        hits = np.equal(seg_label, clstr, out=hits_buf)
+        pos = int(hits.argmax())
+        if not hits[pos]:
+            continue
+        feature = [int(seg_pixels[pos, 0]), int(seg_pixels[pos, 1]), int(seg_pixels[pos, 2])]
+        f_set.append(feature)
+        logger.debug('Cluster: %d - Features: %d %d %d', clstr, feature[0], feature[1], feature[2])
+
     return f_set
 
+# ====================================================================================================
+# Per-cluster statistics of a segmented image: representative feature, pixel count, fraction of the
+# image and mean colour. The mean is taken over src_img (e.g. the HSV input) when given, otherwise
+# over the segmented image itself.
+# i/p: seg_img (H x W x 3), seg_lbl (H*W x 1), o/p: [{'cluster': 0, 'feature': [..], 'pixels': n, ..}, ..]
+# ----------------------------------------------------------------------------------------------------
+def get_cluster_stats(seg_img, seg_lbl, src_img=None):
+    seg_label = seg_lbl.ravel()
+    seg_pixels = seg_img.reshape(-1, 3)
+    ref_pixels = seg_pixels if src_img is None else src_img.reshape(-1, 3)
+
+    counts = np.bincount(seg_label, minlength=NO_OF_CLUSTER)
+    sums = np.stack([np.bincount(seg_label, weights=ref_pixels[:, idc], minlength=NO_OF_CLUSTER) for idc in range(3)], axis=1)
+
+    stats = []
+    for clstr in range(NO_OF_CLUSTER):
+        if counts[clstr] == 0:
+            continue
+        pos = int((seg_label == clstr).argmax())
+        stats.append({
+            'cluster': clstr,
+            'feature': [int(seg_pixels[pos, 0]), int(seg_pixels[pos, 1]), int(seg_pixels[pos, 2])],
+            'pixels': int(counts[clstr]),
+            'fraction': float(counts[clstr]) / seg_label.size,
+            'mean': [float(val) for val in sums[clstr] / counts[clstr]],
+        })
+
+    return stats
+
 # ====================================================================================================
 # Feature Extraction: [Test Images]
 # Extraction of Disease/Non-Disease Segmented HSI Color Features of Test Images
+# With as_frame=False no DataFrame is built (feature_df is None); prediction does not need it.
 # ----------------------------------------------------------------------------------------------------
-def get_features(seg, seg_lbl):
+@timed_stage('features')
+def get_features(seg, seg_lbl, as_frame=True, pool=None):
     feature_set = []
     for idx in range(len(seg)):
-        print('========================================')
-        print('Features Set of Image ' + str(idx + 1))
-        feature_set.append(get_segmented_features_set(seg[idx], seg_lbl[idx]))
+        logger.debug('Features Set of Image %d', idx + 1)
+        feature_set.append(get_segmented_features_set(seg[idx], seg_lbl[idx], pool=pool))
     
     t_feature_set = []
     for idx in range(len(feature_set)):
         for idy in range(len(feature_set[idx])):
             t_feature_set.append(feature_set[idx][idy])
 
+    if not as_frame:
+        return feature_set, None
+
+    import pandas as pd
     feature_df = pd.DataFrame(t_feature_set, columns=['feature_1', 'feature_2', 'feature_3'])
 
     return feature_set, feature_df 
 
 # ====================================================================================================
-# Classify Test Images using Support Vector Classifier Approach basd Train Model
+# Native RBF Support Vector Classifier
+# The parameters of a fitted binary RBF SVC stored as plain .npy arrays in a model directory and
+# loaded by memory mapping instead of unpickling sklearn objects:
+#   support_vectors.npy (S x 3), dual_coef.npy (1 x S), intercept.npy (1), gamma.npy (scalar),
+#   classes.npy (2) and model.json (training details)
+# The decision function follows the signs of sklearn's public dual_coef_ / intercept_:
+#   dec(x) = sum_i dual_coef[i] * exp(-gamma * |x - sv_i|^2) + intercept, label = classes[dec > 0]
 # ----------------------------------------------------------------------------------------------------
-def classify(f_train_df, f_test_df):
-    X_test = f_test_df
-    '''
-    X_train = f_train_df[['feature_1', 'feature_2', 'feature_3']]
-    Y_train = f_train_df[['label']]
-    X_test = f_test_df
-    
-    # Training the Algorithm Support Vector Classifier
-    # Radial Basis Function (RBF Kernel)
-    svclassifier = SVC(kernel='rbf') # 'linear'
-    svclassifier.fit(X_train, Y_train)
-    filename = 'finalized_model.sav'
-    pickle.dump(svclassifier, open(filename, 'wb'))
-    '''
-    # Calculate Prediction
-    filename='finalized_model.sav'
-    svclassifier=pickle.load(open(filename, 'rb'))
-    Y_pred = svclassifier.predict(X_test)
-    
-    f_test_df['pred_lbl'] = Y_pred
-    
-    return f_test_df
+NATIVE_ARRAYS = ('support_vectors', 'dual_coef', 'intercept', 'gamma', 'classes')
+
+class NativeSVC(object):
+    def __init__(self, support_vectors, dual_coef, intercept, gamma, classes, meta=None):
+        self.support_vectors = np.asarray(support_vectors, dtype=np.float64)
+        self.dual_coef = np.asarray(dual_coef, dtype=np.float64).reshape(1, -1)
+        self.intercept = np.asarray(intercept, dtype=np.float64).reshape(1)
+        self.gamma = float(gamma)
+        self.classes = np.asarray(classes)
+        self.meta = meta or {}
+        if self.classes.shape != (2,) or self.dual_coef.shape[1] != self.support_vectors.shape[0]:
+            raise ValueError('a native model holds one binary RBF classifier')
+        self.sv_sq = (self.support_vectors ** 2).sum(axis=1)
+
+    @classmethod
+    def from_sklearn(cls, model, meta=None):
+        if model.kernel != 'rbf' or len(model.classes_) != 2:
+            raise ValueError('only binary RBF SVC models can be converted')
+        # _gamma holds the value of gamma='scale' / 'auto' computed at fit time
+        return cls(model.support_vectors_, model.dual_coef_, model.intercept_, model._gamma, model.classes_, meta)
+
+    @classmethod
+    def load(cls, model_dir):
+        arrays = {name: np.load(os.path.join(model_dir, name + '.npy'), mmap_mode='r') for name in NATIVE_ARRAYS}
+        meta = {}
+        if os.path.exists(os.path.join(model_dir, 'model.json')):
+            with open(os.path.join(model_dir, 'model.json')) as meta_file:
+                meta = json.load(meta_file)
+
+        return cls(meta=meta, **arrays)
+
+    # Written to <model_dir>.tmp and swapped in, so a reader never sees a half-written model
+    def save(self, model_dir):
+        model_dir = model_dir.rstrip('/\\')
+        tmp_dir, old_dir = model_dir + '.tmp', model_dir + '.old'
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        os.makedirs(tmp_dir)
+        for name in NATIVE_ARRAYS:
+            np.save(os.path.join(tmp_dir, name + '.npy'), np.asarray(getattr(self, name)))
+        with open(os.path.join(tmp_dir, 'model.json'), 'w') as meta_file:
+            json.dump(self.meta, meta_file, indent=2)
+        shutil.rmtree(old_dir, ignore_errors=True)
+        if os.path.exists(model_dir):
+            os.replace(model_dir, old_dir)
+        os.replace(tmp_dir, model_dir)
+        shutil.rmtree(old_dir, ignore_errors=True)
+
+    def decision_function(self, features, chunk_size=1 << 16):
+        features = np.asarray(features, dtype=np.float64).reshape(-1, self.support_vectors.shape[1])
+        dec = np.empty(features.shape[0])
+        for start in range(0, features.shape[0], chunk_size):
+            chunk = features[start:start + chunk_size]
+            sq_dist = (chunk ** 2).sum(axis=1)[:, np.newaxis] - 2 * (chunk @ self.support_vectors.T) + self.sv_sq
+            np.maximum(sq_dist, 0, out=sq_dist)
+            dec[start:start + chunk_size] = np.exp(-self.gamma * sq_dist) @ self.dual_coef[0] + self.intercept[0]
+
+        return dec
+
+    def predict(self, features):
+        return self.classes[(self.decision_function(features) > 0).astype(int)]
+
+# ====================================================================================================
+# Model Registry
+# Each tier's classifier is unpickled once and shared by every request thread. At most once every
+# MODEL_CHECK_INTERVAL seconds the model file's mtime is checked; a changed mtime triggers a hash of
+# the file and the model is reloaded only when its content changed. A failed reload keeps serving
+# the previously loaded model.
+# A tier whose MODEL_FOLDER/<tier> directory exists at start-up (written by train_models.py) loads
+# that native model; the other tiers load the pickled MODEL_FILENAME.
+# ----------------------------------------------------------------------------------------------------
+MODEL_FILENAME = 'finalized_model.sav'
+MODEL_FOLDER = os.environ.get('MODEL_FOLDER', './models/')
+TIER_MODELS = {
+    tier: os.path.join(MODEL_FOLDER, tier) if os.path.isdir(os.path.join(MODEL_FOLDER, tier)) else MODEL_FILENAME
+    for tier in ('explored', 'mid_explored', 'begin')
+}
+MODEL_CHECK_INTERVAL = 2.0
+
+_MODEL_REGISTRY = {}
+_MODEL_LOCK = threading.Lock()
+
+# SHA-256 of a model file, or of the names and contents of the files of a native model directory
+def _file_hash(filename):
+    digest = hashlib.sha256()
+    if os.path.isdir(filename):
+        paths = [os.path.join(filename, name) for name in sorted(os.listdir(filename))]
+    else:
+        paths = [filename]
+    for path in paths:
+        if path != filename:
+            digest.update(os.path.basename(path).encode())
+        with open(path, 'rb') as model_file:
+            for chunk in iter(lambda: model_file.read(1 << 20), b''):
+                digest.update(chunk)
+
+    return digest.hexdigest()
+
+def _load_model_entry(filename, file_hash, mtime):
+    start = time.perf_counter()
+    if os.path.isdir(filename):
+        model = NativeSVC.load(filename)
+    else:
+        with open(filename, 'rb') as model_file:
+            model = pickle.load(model_file)
+
+    return {
+        'model': model,
+        'path': filename,
+        'hash': file_hash,
+        'version': file_hash[:12],
+        'mtime': mtime,
+        'load_time': time.perf_counter() - start,
+        'loaded_at': time.time(),
+        'checked_at': time.monotonic(),
+    }
+
+def _refresh_model_entry(filename, entry):
+    try:
+        mtime = os.stat(filename).st_mtime
+        if entry is not None and mtime == entry['mtime']:
+            return dict(entry, checked_at=time.monotonic())
+        file_hash = _file_hash(filename)
+        if entry is not None and file_hash == entry['hash']:
+            return dict(entry, mtime=mtime, checked_at=time.monotonic())
+        entry = _load_model_entry(filename, file_hash, mtime)
+        logger.info('Loaded model %s (version %s) in %.3f s', filename, entry['version'], entry['load_time'])
+        return entry
+    except Exception as err:
+        if entry is None:
+            raise
+        logger.warning('Reload of model %s failed, keeping version %s: %s', filename, entry['version'], err)
+        return dict(entry, checked_at=time.monotonic())
+
+def get_model(tier='explored'):
+    filename = TIER_MODELS[tier]
+    entry = _MODEL_REGISTRY.get(filename)
+    if entry is not None and time.monotonic() - entry['checked_at'] < MODEL_CHECK_INTERVAL:
+        return entry['model']
+
+    with _MODEL_LOCK:
+        # Another thread may have refreshed the entry while this one waited for the lock
+        entry = _MODEL_REGISTRY.get(filename)
+        if entry is None or time.monotonic() - entry['checked_at'] >= MODEL_CHECK_INTERVAL:
+            entry = _refresh_model_entry(filename, entry)
+            _MODEL_REGISTRY[filename] = entry
+
+    return entry['model']
+
+def load_models():
+    for tier in TIER_MODELS:
+        if CLASSIFIER_BACKEND != 'lut' or get_lut(tier) is None:
+            get_model(tier)
 
 # ====================================================================================================
-# Get Significant feature from feasible feature set based on identifying Maximum value on the 2st column 
-# i/p: [[100, 179, 197], [100, 232, 150], [97, 164, 126]], o/p: [100, 232, 150]
+# HSV Lookup Tables
+# The features of every tier are uint8 HSV triples, so a classifier only ever sees 256^3 inputs.
+# compile_lut.py evaluates each tier's model once over the whole grid and stores whether it predicts
+# label 1 as a packed bit table (np.packbits order, 2 MiB) indexed by h << 16 | s << 8 | v. Rules of
+# prediction_batch that only depend on the feature itself are folded into the table (LUT_FOLDED).
+# With CLASSIFIER_BACKEND='lut' the tables are memory mapped from LUT_FOLDER and used instead of the
+# classifier, so the model is never unpickled. A table is only used while the model hash recorded in
+# the manifest matches the tier's model file; otherwise the tier falls back to the classifier.
 # ----------------------------------------------------------------------------------------------------
-def get_significant_feature(f_set):
-    value = []
-    for idx in range(len(f_set)):
-        value.append(f_set[idx][1])
+CLASSIFIER_BACKEND = os.environ.get('CLASSIFIER_BACKEND', 'svc')
+LUT_FOLDER = os.environ.get('LUT_FOLDER', './lut/')
+LUT_MANIFEST = 'manifest.json'
+LUT_BYTES = (1 << 24) // 8
+
+# tier: (feature column, lower bound) -- the begin tier only accepts features with feature_1 > 70
+LUT_FOLDED = {'begin': (0, 70)}
+
+_LUT_REGISTRY = {}
+
+def _lut_stamp(filename):
+    return os.stat(filename).st_mtime, os.stat(os.path.join(LUT_FOLDER, LUT_MANIFEST)).st_mtime
+
+def _load_lut_entry(tier, filename, stamp):
+    start = time.perf_counter()
+    with open(os.path.join(LUT_FOLDER, LUT_MANIFEST)) as manifest_file:
+        info = json.load(manifest_file)['tiers'][tier]
+    file_hash = _file_hash(filename)
+    if info['hash'] != file_hash:
+        raise ValueError('the table was compiled for another version of ' + filename)
+    table = np.load(os.path.join(LUT_FOLDER, info['table']), mmap_mode='r')
+    if table.dtype != np.uint8 or table.shape != (LUT_BYTES,):
+        raise ValueError('malformed table ' + info['table'])
+
+    return {
+        'table': table,
+        'path': os.path.join(LUT_FOLDER, info['table']),
+        'hash': file_hash,
+        'version': file_hash[:12],
+        'stamp': stamp,
+        'load_time': time.perf_counter() - start,
+        'loaded_at': time.time(),
+        'checked_at': time.monotonic(),
+    }
+
+def get_lut(tier):
+    entry = _LUT_REGISTRY.get(tier)
+    if entry is not None and time.monotonic() - entry['checked_at'] < MODEL_CHECK_INTERVAL:
+        return entry['table']
+
+    with _MODEL_LOCK:
+        entry = _LUT_REGISTRY.get(tier)
+        if entry is None or time.monotonic() - entry['checked_at'] >= MODEL_CHECK_INTERVAL:
+            try:
+                stamp = _lut_stamp(TIER_MODELS[tier])
+                if entry is not None and entry['table'] is not None and stamp == entry['stamp']:
+                    entry = dict(entry, checked_at=time.monotonic())
+                else:
+                    entry = _load_lut_entry(tier, TIER_MODELS[tier], stamp)
+                    logger.info('Loaded lookup table %s (version %s) in %.3f s', entry['path'], entry['version'], entry['load_time'])
+            except Exception as err:
+                if entry is None or entry['table'] is not None:
+                    logger.warning('No valid lookup table for tier %s, using the classifier: %s', tier, err)
+                entry = {'table': None, 'checked_at': time.monotonic()}
+            _LUT_REGISTRY[tier] = entry
+
+    return entry['table']
+
+# Table bit of every row of a (N x 3) uint8-range feature array, o/p: 0 / 1 per row
+def lut_predict(table, features):
+    features = np.asarray(features, dtype=np.int64)
+    idx = (features[:,0] << 16) | (features[:,1] << 8) | features[:,2]
+
+    return (table[idx >> 3] >> (7 - (idx & 7))) & 1
 
-    pos = np.where(np.array(value) == np.array(value).max())[0][0]
-    if (int(f_set[pos][1]) > 150) and (int(f_set[pos][0]) > 70): #if int(f_set[pos][0]) > 70:
-        return f_set[pos]
+# ====================================================================================================
+# Loaded model details per tier: backend, path, version (hash prefix), load time and load timestamp
+# ----------------------------------------------------------------------------------------------------
+def _tier_entry(tier):
+    entry = _LUT_REGISTRY.get(tier) if CLASSIFIER_BACKEND == 'lut' else None
+    if entry is not None and entry['table'] is not None:
+        return 'lut', entry
+
+    return 'svc', _MODEL_REGISTRY.get(TIER_MODELS[tier])
+
+def model_info():
+    info = {}
+    for tier, filename in TIER_MODELS.items():
+        backend, entry = _tier_entry(tier)
+        if entry is None:
+            info[tier] = {'path': filename, 'loaded': False}
+            continue
+        info[tier] = {
+            'backend': backend,
+            'path': entry['path'],
+            'loaded': True,
+            'version': entry['version'],
+            'load_time': entry['load_time'],
+            'loaded_at': entry['loaded_at'],
+        }
+
+    return info
+
+def model_version():
+    load_models()
+    versions = []
+    for tier in TIER_MODELS:
+        backend, entry = _tier_entry(tier)
+        if entry['version'] not in versions:
+            versions.append(entry['version'])
+
+    return '-'.join(versions)
+
+# ====================================================================================================
+# Classified Labels
+# ----------------------------------------------------------------------------------------------------
+LABEL_EXPLORED = 'Classified Label: Explored Yellow-Rust Disease'         # Plant Growth: Greater than 4 weeks
+LABEL_MID_EXPLORED = 'Classified Label: Mid-Explored Yellow-Rust Disease' # Plant Growth: 2 - 4 weeks
+LABEL_BEGIN = 'Classified Label: Begin Yellow-Rust Disease'               # Plant Growth: Less than 2 weeks
+LABEL_HEALTHY = 'Classified Label: Healthy Image'
+LABEL_NO_DISEASE = 'Classified Label: No Disease'
+
+# ====================================================================================================
+# Predict the label of every row of a (N x 3) feature array with the given tier's classifier, or its
+# lookup table with CLASSIFIER_BACKEND='lut' (0 / 1: whether the classifier predicts label 1)
+# ----------------------------------------------------------------------------------------------------
+def predict_tier(features, tier):
+    if len(features) == 0:
+        return np.zeros(0, dtype=int)
+
+    start = time.perf_counter()
+    table = get_lut(tier) if CLASSIFIER_BACKEND == 'lut' else None
+    if table is not None:
+        pred = lut_predict(table, features)
     else:
-        return []
+        pred = np.asarray(get_model(tier).predict(features))
+    observe_metric('plant_stage_seconds', time.perf_counter() - start, stage='classify_' + tier)
+
+    return pred
+
+# ====================================================================================================
+# First row per image among the given (ascending) rows, o/p: image indices, row indices
+# ----------------------------------------------------------------------------------------------------
+def _first_row_per_image(img_idx, rows):
+    images, first = np.unique(img_idx[rows], return_index=True)
+
+    return images, rows[first]
+
+# ====================================================================================================
+# Predict the Disease Level of a batch of images [ Test Images ]
+# The cluster features of all images are stacked into one array, each tier's classifier runs once over
+# the rows of the images still undecided, and the explored -> mid-explored -> begin cascade is applied
+# with array masks.
+#   Explored     : valid rows with the maximum feature_2 decides, disease if feature_2 > 150 and
+#                  feature_1 > 70, otherwise healthy
+#   Mid-Explored : first valid row decides, disease if feature_3 > 65, otherwise healthy
+#   Begin        : first valid row with feature_1 > 70
+# ----------------------------------------------------------------------------------------------------
+def prediction_batch(t_features, count_labels=True):
+    no_of_img = len(t_features)
+    img_idx = np.repeat(np.arange(no_of_img), [len(f_set) for f_set in t_features])
+    features = np.array([feature for f_set in t_features for feature in f_set], dtype=np.int64).reshape(-1, 3)
+
+    classified_f = [[] for idx in range(no_of_img)]
+    classified_f_label = [LABEL_NO_DISEASE] * no_of_img
+    pending = np.ones(no_of_img, dtype=bool)
+
+    # Tier 1: Explored
+    pred_expl = predict_tier(features, 'explored')
+    valid = np.flatnonzero(pred_expl == 1)
+    if valid.size > 0:
+        # Within each image: highest feature_2 first, ties broken by the original row order
+        valid = valid[np.lexsort((valid, -features[valid, 1], img_idx[valid]))]
+        images, rows = _first_row_per_image(img_idx, valid)
+        detected = (features[rows, 1] > 150) & (features[rows, 0] > 70)
+        for image, row, hit in zip(images, rows, detected):
+            if hit:
+                classified_f[image] = features[row].tolist()
+                classified_f_label[image] = LABEL_EXPLORED
+            else:
+                classified_f_label[image] = LABEL_HEALTHY
+        pending[images] = False
+
+    # Tier 2: Mid-Explored
+    rows = np.flatnonzero(pending[img_idx])
+    pred_mid = predict_tier(features[rows], 'mid_explored')
+    images, rows = _first_row_per_image(img_idx, rows[pred_mid == 1])
+    for image, row in zip(images, rows):
+        if features[row, 2] > 65:
+            classified_f[image] = features[row].tolist()
+            classified_f_label[image] = LABEL_MID_EXPLORED
+        else:
+            classified_f_label[image] = LABEL_HEALTHY
+    pending[images] = False
+
+    # Tier 3: Begin
+    rows = np.flatnonzero(pending[img_idx])
+    pred_begn = predict_tier(features[rows], 'begin')
+    images, rows = _first_row_per_image(img_idx, rows[(pred_begn == 1) & (features[rows, 0] > 70)])
+    for image, row in zip(images, rows):
+        classified_f[image] = features[row].tolist()
+        classified_f_label[image] = LABEL_BEGIN
+
+    if count_labels:
+        for label in classified_f_label:
+            inc_metric('plant_labels_total', label=label.replace('Classified Label: ', ''))
+
+    return classified_f, classified_f_label
 
 # ====================================================================================================
 # Predict the Disease Level [ Test Images ]
 # ----------------------------------------------------------------------------------------------------
+@timed_stage('prediction')
 def prediction(t_features, t_feature_df):
-    classified_f = []
-    classified_f_label = []
-    #grw_period = []  # growth_period
-    
-    for idx in range(len(t_features)):
-        t_feature_set = []
-        valid_features = []
-        lbl_feature_test = pd.DataFrame()
-        lbl_feature_begin_test = pd.DataFrame()
-        trigger = 0
-        for idy in range(len(t_features[idx])):
-            t_feature_set.append(t_features[idx][idy])
-
-        print('t_feature_set')
-        print(t_feature_set)
-        
-        feature_df_test = pd.DataFrame(t_feature_set, columns=['feature_1', 'feature_2', 'feature_3'])
-        lbl_feature_test = classify(FEATURE_EXPL_DF, feature_df_test[['feature_1', 'feature_2', 'feature_3']]) #t_feature_df
-        print('================== lbl_feature_test =======================')
-        print(lbl_feature_test)
-
-        for idz in range(len(lbl_feature_test)):
-            if lbl_feature_test['pred_lbl'][idz] == 1: # and trigger == 0
-                valid_features.append([lbl_feature_test['feature_1'][idz], lbl_feature_test['feature_2'][idz], lbl_feature_test['feature_3'][idz]])
-                trigger = 1
-        
-        if trigger == 1:
-            if len(get_significant_feature(valid_features)) > 0:
-                classified_f.append(get_significant_feature(valid_features))
-                classified_f_label.append('Classified Label: Explored Yellow-Rust Disease') #\nPlant Growth: Greater than 4 weeks')
-            else:
-                classified_f.append([])
-                classified_f_label.append('Classified Label: Healthy Image')
-            
-            #grw_period.append('Plant Growth: Greater than 4 weeks')                
-
-        if trigger == 0:
-            lbl_feature_mid_expl_test = classify(FEATURE_MID_EXPL_DF, feature_df_test[['feature_1', 'feature_2', 'feature_3']]) # t_feature_df
-            print('================== lbl_feature_mid_expl_test =======================')
-            print(lbl_feature_mid_expl_test)
-
-            for idv in range(len(lbl_feature_mid_expl_test)):
-                if lbl_feature_mid_expl_test['pred_lbl'][idv] == 1:
-                    if int(lbl_feature_mid_expl_test['feature_3'][idv]) > 65:
-                        classified_f.append([lbl_feature_mid_expl_test['feature_1'][idv], lbl_feature_mid_expl_test['feature_2'][idv], lbl_feature_mid_expl_test['feature_3'][idv]])
-                        classified_f_label.append('Classified Label: Mid-Explored Yellow-Rust Disease') #\nPlant Growth: 2 - 4 weeks')
-                        #grw_period.append('Plant Growth: 2 - 4 weeks')
-                    else:
-                        classified_f.append([])
-                        classified_f_label.append('Classified Label: Healthy Image')                        
-                    trigger = 1
-                    break
+    logger.debug('t_feature_set: %s', t_features)
 
-        if trigger == 0:
-            lbl_feature_begin_test = classify(FEATURE_BEGN_DF, feature_df_test[['feature_1', 'feature_2', 'feature_3']])  # t_feature_df
-            print('================== lbl_feature_begin_test =======================')
-            print(lbl_feature_begin_test)
-
-            for idv in range(len(lbl_feature_begin_test)):
-                if lbl_feature_begin_test['pred_lbl'][idv] == 1 and lbl_feature_begin_test['feature_1'][idv] > 70:
-                    classified_f.append([lbl_feature_begin_test['feature_1'][idv], lbl_feature_begin_test['feature_2'][idv], lbl_feature_begin_test['feature_3'][idv]])
-                    classified_f_label.append('Classified Label: Begin Yellow-Rust Disease') #\nPlant Growth: Less than 2 weeks')
-                    #grw_period.append('Plant Growth: Less than 2 weeks')
-                    trigger = 1
-                    break
+    return prediction_batch(t_features)
 
-        if trigger == 0:
-            classified_f.append([])
-            classified_f_label.append('Classified Label: No Disease')
+# ====================================================================================================
+# Boolean mask of the pixels whose segmented colour equals the detected feature
+# The mask is written into out, the per-channel comparison into a buffer of pool when given.
+# i/p: seg_img (H x W x 3), det_featr [f1, f2, f3], o/p: mask (H x W, bool)
+# ----------------------------------------------------------------------------------------------------
+def get_classified_mask(seg_img, det_featr, out=None, pool=None):
+    mask = np.equal(seg_img[:,:,0], int(det_featr[0]), out=out)
+    hits = pool.get('mask_channel', mask.shape, bool) if pool is not None else None
+    mask &= np.equal(seg_img[:,:,1], int(det_featr[1]), out=hits)
+    mask &= np.equal(seg_img[:,:,2], int(det_featr[2]), out=hits)
 
-    return classified_f, classified_f_label
+    return mask
 
 # ====================================================================================================
 # Extraction of Disease Segmented Region of Interest based on Classification
+# The segmented features and the enhanced pixels under the detection mask are copied straight into
+# uint8 outputs; everything else stays black. With return_mask the mask is returned as well so
+# callers can reuse it for overlays or area statistics. The ROI is written into out, the mask and
+# segmented ROI into buffers of pool when given (see Buffer Pool).
 # ----------------------------------------------------------------------------------------------------
-def get_classified_region(seg_img, det_featr, enh_img, f_label):
-    seg_det_img = np.zeros((seg_img.shape[0],seg_img.shape[1],3), dtype = int)
-    roi_img = np.zeros((seg_img.shape[0],seg_img.shape[1],3), dtype = int)
-    for idx in range(seg_img.shape[0]):
-        for idy in range(seg_img.shape[1]):
-            if int(seg_img[idx][idy][0]) == int(det_featr[0]) and int(seg_img[idx][idy][1]) == int(det_featr[1]) and int(seg_img[idx][idy][2]) == int(det_featr[2]):
-                seg_det_img[idx,idy,0] = int(seg_img[idx,idy,0])
-                seg_det_img[idx,idy,1] = int(seg_img[idx,idy,1])
-                seg_det_img[idx,idy,2] = int(seg_img[idx,idy,2])
-                
-                roi_img[idx,idy,0] = enh_img[idx,idy,0]
-                roi_img[idx,idy,1] = enh_img[idx,idy,1]
-                roi_img[idx,idy,2] = enh_img[idx,idy,2]    
-
-    seg_grp_img = np.uint8(seg_det_img)
-    roi_grp_img = np.uint8(roi_img)
+@timed_stage('region')
+def get_classified_region(seg_img, det_featr, enh_img, f_label, return_mask=False, out=None, pool=None):
+    shape = (seg_img.shape[0],seg_img.shape[1],3)
+    mask = get_classified_mask(seg_img, det_featr, out=pool.get('region_mask', shape[:2], bool) if pool is not None else None, pool=pool)
+    mask_3d = mask[:,:,np.newaxis]
+
+    if pool is not None:
+        seg_grp_img = pool.get('seg_grp', shape)
+        seg_grp_img.fill(0)
+    else:
+        seg_grp_img = np.zeros(shape, dtype = np.uint8)
+    if out is not None:
+        roi_grp_img = out
+        roi_grp_img.fill(0)
+    else:
+        roi_grp_img = np.zeros(shape, dtype = np.uint8)
+    np.copyto(seg_grp_img, seg_img, where=mask_3d)
+    np.copyto(roi_grp_img, enh_img, where=mask_3d)
 
     #result_img = [ enh_img, seg_grp_img, roi_grp_img ]
     #res_img_title = ['Input Image', 'Segmented ROI Features', f_label]
@@ -504,108 +1238,1472 @@ def get_classified_region(seg_img, det_featr, enh_img, f_label):
     res_img_title = ['Input Image', f_label]
     
     ##show_feature_diagram(result_img, res_img_title)
-    
+
+    if return_mask:
+        return seg_grp_img, roi_grp_img, mask
+
     return seg_grp_img, roi_grp_img
 
+# ====================================================================================================
+# Rendering Settings
+# RENDER_BACKEND: 'opencv' composes the result panels directly with NumPy/OpenCV, 'matplotlib' keeps
+# the original pyplot figure. PNG_COMPRESSION is the zlib level (0-9) of the OpenCV encoder and
+# RENDER_MAX_HEIGHT caps the panel height (larger inputs are downscaled before composing).
+# ----------------------------------------------------------------------------------------------------
+RENDER_BACKEND = os.environ.get('RENDER_BACKEND', 'opencv')
+PNG_COMPRESSION = 3
+RENDER_MAX_HEIGHT = 1000
+RENDER_MARGIN = 20
+
+# ====================================================================================================
+# Compose the result panels side by side on a white canvas with each title centred above its panel
+# The downscaled panels and the canvas are taken from pool when given (see Buffer Pool).
+# i/p: list of RGB uint8 images, list of titles, o/p: RGB uint8 canvas
+# ----------------------------------------------------------------------------------------------------
+def compose_prediction(inp_img, input_img_title, max_height=None, pool=None):
+    max_height = max_height or RENDER_MAX_HEIGHT
+    height = min(max(img.shape[0] for img in inp_img), max_height)
+
+    panels = []
+    for idx, img in enumerate(inp_img):
+        width = max(1, int(round(img.shape[1] * height / img.shape[0])))
+        if img.shape[:2] != (height, width):
+            panel = pool.get('render_panel_%d' % idx, (height, width, 3)) if pool is not None else None
+            img = cv.resize(img, (width, height), dst=panel, interpolation=cv.INTER_AREA)
+        panels.append(img)
+
+    # Title band: text height about 3% of the panel height, shrunk to fit the panel width
+    font = cv.FONT_HERSHEY_SIMPLEX
+    font_scale = max(height / 1000.0, 0.4)
+    thickness = max(1, int(round(font_scale * 2)))
+    band = int(round(cv.getTextSize('Ag', font, font_scale, thickness)[0][1] * 2.5)) + RENDER_MARGIN
+
+    canvas_width = sum(panel.shape[1] for panel in panels) + RENDER_MARGIN * (len(panels) + 1)
+    canvas_shape = (height + band + RENDER_MARGIN, canvas_width, 3)
+    if pool is not None:
+        canvas = pool.get('render_canvas', canvas_shape)
+        canvas.fill(255)
+    else:
+        canvas = np.full(canvas_shape, 255, dtype=np.uint8)
+
+    left = RENDER_MARGIN
+    for panel, title in zip(panels, input_img_title):
+        canvas[band:band + height, left:left + panel.shape[1]] = panel
+
+        scale = font_scale
+        (text_width, text_height), baseline = cv.getTextSize(title, font, scale, thickness)
+        if text_width > panel.shape[1]:
+            scale = scale * panel.shape[1] / text_width
+            (text_width, text_height), baseline = cv.getTextSize(title, font, scale, thickness)
+        origin = (left + (panel.shape[1] - text_width) // 2, band - RENDER_MARGIN // 2 - baseline)
+        cv.putText(canvas, title, origin, font, scale, (0, 0, 0), thickness, cv.LINE_AA)
+
+        left += panel.shape[1] + RENDER_MARGIN
+
+    return canvas
+
+# ====================================================================================================
+# Encode the composed result panels as PNG bytes
+# ----------------------------------------------------------------------------------------------------
+def render_prediction(inp_img, input_img_title, compression=None, pool=None):
+    canvas = compose_prediction(inp_img, input_img_title, pool=pool)
+    compression = PNG_COMPRESSION if compression is None else compression
+    bgr_canvas = pool.get('render_bgr', canvas.shape) if pool is not None else None
+    ok, png = cv.imencode('.png', cv.cvtColor(canvas, cv.COLOR_RGB2BGR, dst=bgr_canvas), [cv.IMWRITE_PNG_COMPRESSION, compression])
+    if not ok:
+        raise ValueError('PNG encoding of the prediction failed')
+
+    return png.tobytes()
+
 # ====================================================================================================
 # Save the prediction
 # ----------------------------------------------------------------------------------------------------
-def save_prediction(inp_img, input_img_title, img_path):
-    fig = plt.figure(figsize=(20, 20))
+@timed_stage('render')
+def save_prediction(inp_img, input_img_title, img_path, backend=None, compression=None):
+    if (backend or RENDER_BACKEND) == 'matplotlib':
+        save_prediction_matplotlib(inp_img, input_img_title, img_path)
+        return
+
+    png = render_prediction(inp_img, input_img_title, compression)
+    with open(img_path, 'wb') as img_file:
+        img_file.write(png)
+
+# ====================================================================================================
+# Save the prediction as a matplotlib figure (original layout). The figure is built with the
+# object-oriented API instead of pyplot, so no global figure state is shared between request threads
+# and nothing has to be closed afterwards. matplotlib is imported on first use.
+# ----------------------------------------------------------------------------------------------------
+def save_prediction_matplotlib(inp_img, input_img_title, img_path):
+    from matplotlib.figure import Figure
+
+    fig = Figure(figsize=(20, 20))
     rows = 1
     columns = len(inp_img)
 
     for idx in range(len(inp_img)):
-        fig.add_subplot(rows, columns, idx+1)
-        plt.imshow(inp_img[idx])
-        plt.title(input_img_title[idx])
-        plt.axis('off')
+        axes = fig.add_subplot(rows, columns, idx+1)
+        axes.imshow(inp_img[idx])
+        axes.set_title(input_img_title[idx])
+        axes.axis('off')
     fig.savefig(img_path, facecolor ="w")
 
+# ====================================================================================================
+# Thumbnail Pre-Screen
+# The image is downscaled to PRESCREEN_SIDE pixels on its longest side and segmented, and its cluster
+# features are classified. The result is confidently negative when the thumbnail is Healthy or No
+# Disease and stays so with every cluster colour shifted by -PRESCREEN_MARGIN, 0 or +PRESCREEN_MARGIN
+# HSV levels per channel (27 shifted feature sets, classified in the same prediction_batch call);
+# a larger margin escalates more images to the full-resolution pipeline. The thumbnail is a
+# nearest-neighbour subsample, not an area average: like the pixel sample of fast mode it keeps the
+# colour of small rust pustules, which averaging blends into the surrounding leaf. PRESCREEN=1
+# enables the cascade in detect() and analyze_image().
+# ----------------------------------------------------------------------------------------------------
+PRESCREEN = os.environ.get('PRESCREEN', '0') == '1'
+PRESCREEN_SIDE = int(os.environ.get('PRESCREEN_SIDE', 256))
+PRESCREEN_MARGIN = int(os.environ.get('PRESCREEN_MARGIN', 8))
+
+NEGATIVE_LABELS = (LABEL_HEALTHY, LABEL_NO_DISEASE)
+
+def thumbnail(inp_img, side=None):
+    side = side or PRESCREEN_SIDE
+    scale = side / float(max(inp_img.shape[:2]))
+    if scale >= 1:
+        return inp_img
+
+    size = (max(1, int(round(inp_img.shape[1] * scale))), max(1, int(round(inp_img.shape[0] * scale))))
+    return cv.resize(inp_img, size, interpolation=cv.INTER_NEAREST)
+
+def prescreen_image(inp_img, seg_mode=None, side=None, margin=None):
+    margin = PRESCREEN_MARGIN if margin is None else margin
+    thumb_img = thumbnail(inp_img, side)
+    seg_img, seg_lbl = segmentation_process(cv.cvtColor(thumb_img, cv.COLOR_RGB2HSV), mode=seg_mode)
+    feature_set, feature_df = get_features([seg_img], [seg_lbl], as_frame=False)
+
+    steps = sorted({0, -margin, margin})
+    shifts = [(0, 0, 0)] + [(dh, ds, dv) for dh in steps for ds in steps for dv in steps if (dh, ds, dv) != (0, 0, 0)]
+    features = np.array(feature_set[0], dtype=np.int64).reshape(-1, 3)
+    shifted = [np.clip(features + shift, 0, 255).tolist() for shift in shifts]
+    classified_f, classified_f_label = prediction_batch(shifted, count_labels=False)
+
+    confident = all(label in NEGATIVE_LABELS for label in classified_f_label)
+    inc_metric('plant_prescreen_total', outcome='negative' if confident else 'escalated')
+
+    return {
+        'label': classified_f_label[0],
+        'features': feature_set[0],
+        'confident': confident,
+        'seg_img': seg_img,
+        'seg_lbl': seg_lbl,
+        'height': thumb_img.shape[0],
+        'width': thumb_img.shape[1],
+    }
+
+def _prescreen_info(screen):
+    return {'label': screen['label'], 'escalated': not screen['confident'], 'height': screen['height'], 'width': screen['width']}
+
+# ====================================================================================================
+# Lazy Pipeline Stages
+# The intermediates of one image are computed on first access and memoized: stages['roi_img'] pulls
+# in the outcome, the prediction, the segmentation, .. but nothing the requested value does not need.
+# The enhanced image is only computed for a rendered panel (a detected disease or a Healthy leaf), so
+# summaries without rendering and No Disease outcomes never run the enhancement.
+# ran lists the stages that ran in completion order (dependencies first), timings their own seconds
+# (excluding the stages they pulled in). With prescreen the outcome is answered by the thumbnail
+# pre-screen when it is confident. With a pool the full-size stage outputs and working arrays are
+# written into its buffers (see Buffer Pool) and are only valid until the lease is released.
+# ----------------------------------------------------------------------------------------------------
+PIPELINE_STAGES = {}
+
+def pipeline_stage(name):
+    def decorator(func):
+        PIPELINE_STAGES[name] = func
+        return func
+    return decorator
+
+class PipelineStages(object):
+    def __init__(self, inp_img, seg_mode=None, prescreen=False, pool=None):
+        self.source = inp_img
+        self.seg_mode = seg_mode
+        self.prescreen = prescreen
+        self.pool = pool
+        self.ran = []
+        self.timings = {}
+        self._values = {}
+        self._nested = 0.0
+
+    def __getitem__(self, name):
+        if name not in self._values:
+            outer = self._nested
+            self._nested = 0.0
+            start = time.perf_counter()
+            try:
+                self._values[name] = PIPELINE_STAGES[name](self)
+            finally:
+                elapsed = time.perf_counter() - start
+                self.timings[name] = elapsed - self._nested
+                self._nested = outer + elapsed
+            self.ran.append(name)
+
+        return self._values[name]
+
+    # Value of a stage that already ran, default otherwise (nothing is computed)
+    def peek(self, name, default=None):
+        return self._values.get(name, default)
+
+    def screened(self):
+        return self.prescreen and self['prescreen']['confident']
+
+    # Buffer of the pool, None without a pool (the stage allocates its output)
+    def buffer(self, name, shape, dtype=np.uint8):
+        return self.pool.get(name, shape, dtype) if self.pool is not None else None
+
+@pipeline_stage('decode')
+def _decode_stage(stages):
+    inp_img = read_image(stages.source)
+    observe_metric('plant_image_megapixels', inp_img.shape[0] * inp_img.shape[1] / 1e6)
+
+    return inp_img
+
+@pipeline_stage('prescreen')
+def _prescreen_stage(stages):
+    return prescreen_image(stages['decode'], seg_mode=stages.seg_mode)
+
+# Convert Color to HSV Color Model (channels read in RGB order, as the model was trained), segment it
+@pipeline_stage('segmentation')
+def _segmentation_stage(stages):
+    inp_img = stages['decode']
+    hsv_cmap = cv.cvtColor(inp_img, cv.COLOR_RGB2HSV, dst=stages.buffer('hsv', inp_img.shape))
+    return segmentation_process(hsv_cmap, mode=stages.seg_mode, out=stages.buffer('seg_img', inp_img.shape), pool=stages.pool)
+
+@pipeline_stage('features')
+def _features_stage(stages):
+    seg_img, seg_lbl = stages['segmentation']
+    return get_features([seg_img], [seg_lbl], as_frame=False, pool=stages.pool)
+
+@pipeline_stage('prediction')
+def _prediction_stage(stages):
+    feature_set, feature_df = stages['features']
+    return prediction(feature_set, feature_df)
+
+# Label, detected feature ([] without disease) and cluster features of the image
+@pipeline_stage('outcome')
+def _outcome_stage(stages):
+    if stages.screened():
+        screen = stages['prescreen']
+        inc_metric('plant_labels_total', label=screen['label'].replace('Classified Label: ', ''))
+        return screen['label'], [], screen['features']
+
+    classified_f, classified_f_label = stages['prediction']
+    return classified_f_label[0], classified_f[0], stages['features'][0][0]
+
+# Enhanced RGB image of the full-resolution input
+@pipeline_stage('enhancement')
+def _enhancement_stage(stages):
+    inp_img = stages['decode']
+    return enhancement(inp_img, swap_rb=True, out=stages.buffer('enh_img', inp_img.shape), pool=stages.pool)
+
+# Disease mask (pixels whose segmented colour equals the detected feature), None without disease
+@pipeline_stage('mask')
+def _mask_stage(stages):
+    label, feature, features = stages['outcome']
+    if len(feature) == 0:
+        return None
+
+    seg_img = stages['segmentation'][0]
+    return get_classified_mask(seg_img, feature, out=stages.buffer('mask', seg_img.shape[:2], bool), pool=stages.pool)
+
+@pipeline_stage('region')
+def _region_stage(stages):
+    label, feature, features = stages['outcome']
+    seg_img = stages['segmentation'][0]
+    seg_grp_img, roi_grp_img = get_classified_region(seg_img, feature, stages['enhancement'], label, out=stages.buffer('roi_img', seg_img.shape),
+                                                     pool=stages.pool)
+
+    return roi_grp_img
+
+# Panel rendered next to the input image: the classified region for a detected disease, the enhanced
+# image for a healthy leaf and None when no disease is found (nothing is rendered)
+@pipeline_stage('roi_img')
+def _roi_img_stage(stages):
+    label, feature, features = stages['outcome']
+    if len(feature) > 0:
+        return stages['region']
+    if label == LABEL_HEALTHY:
+        return stages['enhancement']
+
+    return None
+
+# Per-cluster statistics of the full-resolution segmentation, or of the thumbnail when pre-screened
+@pipeline_stage('clusters')
+def _clusters_stage(stages):
+    if stages.screened():
+        screen = stages['prescreen']
+        return get_cluster_stats(screen['seg_img'], screen['seg_lbl'])
+
+    return get_cluster_stats(*stages['segmentation'])
+
+# ====================================================================================================
+# Detection Pipeline
+# Runs the decode -> segmentation -> features -> prediction stages on one image (a path, an in-memory
+# buffer or a decoded BGR image) and, with render, the enhancement and region stages of the rendered
+# panels. roi_img is the panel rendered next to the input image (see the roi_img stage); it is None
+# without render. 'stages' lists the stages that ran, 'timings' their seconds plus the total.
+# With the pre-screen (prescreen, default PRESCREEN) a confidently negative thumbnail result is
+# returned at once: only a Healthy leaf is enhanced at full resolution (for rendering), and seg_img
+# is None. 'prescreen' holds the thumbnail outcome, or None without the pre-screen.
+# With a pool (a BufferLease, see Buffer Pool) the returned images live in its buffers: use them
+# before the lease is released.
+# ----------------------------------------------------------------------------------------------------
+def detect(inp_img_path, seg_mode=None, prescreen=None, render=True, pool=None):
+    start = time.perf_counter()
+    stages = PipelineStages(inp_img_path, seg_mode=seg_mode, prescreen=PRESCREEN if prescreen is None else prescreen, pool=pool)
+    height, width = stages['decode'].shape[:2]
+    label, feature, features = stages['outcome']
+    roi_img = stages['roi_img'] if render else None
+
+    timings = dict(stages.timings)
+    timings['total'] = time.perf_counter() - start
+    segmentation = stages.peek('segmentation')
+
+    return {
+        'label': label,
+        'feature': feature,
+        'features': features,
+        'height': height,
+        'width': width,
+        'enh_img': stages.peek('enhancement'),
+        'seg_img': segmentation[0] if segmentation is not None else None,
+        'roi_img': roi_img,
+        'prescreen': _prescreen_info(stages['prescreen']) if stages.prescreen else None,
+        'stages': list(stages.ran),
+        'timings': timings,
+    }
+
+# ====================================================================================================
+# Run-length encoding of a boolean mask in row-major order. counts alternate between runs of False
+# and True pixels, starting with False (a mask starting with True begins with a zero-length run).
+# i/p: mask (H x W, bool), o/p: {'size': [H, W], 'order': 'C', 'counts': [..]}
+# ----------------------------------------------------------------------------------------------------
+def rle_encode(mask):
+    flat = mask.ravel()
+    if flat.size == 0:
+        return {'size': list(mask.shape), 'order': 'C', 'counts': []}
+    change = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    counts = np.diff(np.concatenate(([0], change, [flat.size])))
+    if flat[0]:
+        counts = np.concatenate(([0], counts))
+
+    return {'size': list(mask.shape), 'order': 'C', 'counts': counts.tolist()}
+
+def rle_decode(rle):
+    values = np.arange(len(rle['counts'])) % 2 == 1
+    flat = np.repeat(values, rle['counts'])
+
+    return flat.reshape(rle['size'])
+
+# ====================================================================================================
+# Classification summary without rendering: label, significant feature, per-cluster statistics and
+# the diseased area (pixels whose segmented colour equals the significant feature). With with_mask
+# the run-length encoded disease mask is included. With the pre-screen a confidently negative result
+# is answered from the thumbnail (cluster statistics of the thumbnail, no diseased area). The image
+# is never enhanced. No array of the summary outlives the call, so the run leases pooled buffers.
+# i/p: image path or decoded BGR image
+# ----------------------------------------------------------------------------------------------------
+def analyze_image(inp_img, with_mask=False, seg_mode=None, prescreen=None):
+    start = time.perf_counter()
+    pool = lease_buffers()
+    try:
+        stages = PipelineStages(inp_img, seg_mode=seg_mode, prescreen=PRESCREEN if prescreen is None else prescreen, pool=pool)
+        height, width = stages['decode'].shape[:2]
+        label, feature, features = stages['outcome']
+        mask = stages['mask']
+
+        summary = {
+            'label': label,
+            'disease': len(feature) > 0,
+            'feature': feature,
+            'clusters': stages['clusters'],
+            'height': height,
+            'width': width,
+            'area': {'pixels': 0, 'fraction': 0.0},
+            'prescreen': _prescreen_info(stages['prescreen']) if stages.prescreen else None,
+        }
+        if mask is not None:
+            area = int(np.count_nonzero(mask))
+            summary['area'] = {'pixels': area, 'fraction': area / float(height * width)}
+        if with_mask:
+            summary['mask'] = rle_encode(mask if mask is not None else np.zeros((height, width), dtype=bool))
+        summary['stages'] = list(stages.ran)
+        summary['timings'] = dict(stages.timings)
+        summary['timings']['total'] = time.perf_counter() - start
+    finally:
+        if pool is not None:
+            pool.release()
+
+    return summary
+
+# ====================================================================================================
+# Render the input image and classified region of a detect() result, o/p: False if nothing to render
+# ----------------------------------------------------------------------------------------------------
+def save_result(result, img_path):
+    if result['roi_img'] is None:
+        return False
+
+    stage = time.perf_counter()
+    save_prediction([result['enh_img'], result['roi_img']], ['Input Image', result['label']], img_path)
+    result['timings']['render'] = time.perf_counter() - stage
+
+    return True
+
+# ====================================================================================================
+# Render the input image and classified region of a detect() result into PNG bytes with the
+# configured backend, o/p: None if nothing to render. The OpenCV backend composes into buffers of
+# pool when given (see Buffer Pool).
+# ----------------------------------------------------------------------------------------------------
+@timed_stage('render')
+def render_result(result, backend=None, pool=None):
+    if result['roi_img'] is None:
+        return None
+
+    stage = time.perf_counter()
+    panels, titles = [result['enh_img'], result['roi_img']], ['Input Image', result['label']]
+    if (backend or RENDER_BACKEND) == 'matplotlib':
+        png_file = io.BytesIO()
+        save_prediction_matplotlib(panels, titles, png_file)
+        png = png_file.getvalue()
+    else:
+        png = render_prediction(panels, titles, pool=pool)
+    result['timings']['render'] = time.perf_counter() - stage
+
+    return png
+
+# ====================================================================================================
+# Tiled Processing
+# Memory-bounded pipeline for large drone images and orthomosaics. The K-Means centers are fitted once
+# on a pixel sample of the whole image (as in the fast segmentation mode); the image is then streamed
+# in TILE_SIZE x TILE_SIZE tiles:
+#   pass 1: HSV conversion and nearest-center labels per tile -> labels raster, tile feature sets
+#   batch : every tile plus the whole image classified in one prediction_batch call
+#   pass 2: enhancement and ROI extraction of the diseased tiles -> roi / mask rasters
+# The rasters are .npy memory maps in out_dir, so besides the source image only tile-sized buffers
+# are held in memory. Only a .npy source (H x W x 3, BGR uint8) is itself memory mapped, so only .npy
+# inputs are memory-bounded end to end: OpenCV cannot decode part of a JPEG/PNG/TIFF, so any other
+# source is decoded whole (3 bytes per pixel, ~300 MB for 100 MP) before tiling. Convert very large
+# mosaics to .npy once (e.g. with a tiled TIFF reader) to keep them out of memory.
+# CLAHE is applied per tile, so the ROI contrast differs slightly from a whole-image enhancement.
+# ----------------------------------------------------------------------------------------------------
+TILE_SIZE = int(os.environ.get('TILE_SIZE', 1024))
+
+# Codes of the per-tile disease map
+TILE_LABELS = [LABEL_NO_DISEASE, LABEL_HEALTHY, LABEL_BEGIN, LABEL_MID_EXPLORED, LABEL_EXPLORED]
+
+def read_raster(inp_img):
+    if isinstance(inp_img, str) and inp_img.lower().endswith('.npy'):
+        return np.load(inp_img, mmap_mode='r')
+
+    return read_image(inp_img)
+
+def iter_tiles(height, width, tile_size):
+    for y0 in range(0, height, tile_size):
+        for x0 in range(0, width, tile_size):
+            yield slice(y0, min(y0 + tile_size, height)), slice(x0, min(x0 + tile_size, width))
+
+def process_tiled(inp_img_path, out_dir, tile_size=None, seed=None, sample_size=None):
+    timings = {}
+    tile_size = tile_size or TILE_SIZE
+    start = time.perf_counter()
+    inp_img = read_raster(inp_img_path)
+    height, width = inp_img.shape[:2]
+    observe_metric('plant_image_megapixels', height * width / 1e6)
+    timings['read'] = time.perf_counter() - start
+
+    # Global centers: HSV of a pixel sample (channels read in RGB order, as in process())
+    stage = time.perf_counter()
+    sample = sample_pixels(inp_img.reshape((-1,3)), sample_size, seed)
+    sample_hsv = cv.cvtColor(np.ascontiguousarray(sample).reshape((-1,1,3)), cv.COLOR_RGB2HSV).reshape((-1,3))
+    centers = fit_centers(sample_hsv, seed)
+    centers_u8 = np.uint8(centers)
+    timings['centers'] = time.perf_counter() - stage
+
+    os.makedirs(out_dir, exist_ok=True)
+    paths = {name: os.path.join(out_dir, name + '.npy') for name in ('labels', 'mask', 'roi', 'disease_map', 'area_map')}
+    tiles = list(iter_tiles(height, width, tile_size))
+    grid = (-(-height // tile_size), -(-width // tile_size))
+
+    # Pass 1: cluster labels and feature set of every tile
+    stage = time.perf_counter()
+    label_map = np.lib.format.open_memmap(paths['labels'], mode='w+', dtype=np.uint8, shape=(height, width))
+    tile_features = []
+    counts = np.zeros(NO_OF_CLUSTER, dtype=np.int64)
+    for rows, cols in tiles:
+        hsv_tile = cv.cvtColor(np.ascontiguousarray(inp_img[rows, cols]), cv.COLOR_RGB2HSV)
+        tile_lbl = assign_labels(hsv_tile.reshape((-1,3)), centers)
+        label_map[rows, cols] = tile_lbl.reshape(hsv_tile.shape[:2])
+        counts += np.bincount(tile_lbl.ravel(), minlength=NO_OF_CLUSTER)
+        tile_features.append(get_segmented_features_set(centers_u8[tile_lbl.ravel()], tile_lbl))
+    timings['segmentation'] = time.perf_counter() - stage
+
+    # Classification of all tiles and of the whole image (every cluster present anywhere) in one batch
+    stage = time.perf_counter()
+    image_features = [centers_u8[clstr].tolist() for clstr in range(NO_OF_CLUSTER) if counts[clstr] > 0]
+    # Only the overall label counts as a classified image in plant_labels_total, not every tile
+    classified_f, classified_f_label = prediction_batch(tile_features + [image_features], count_labels=False)
+    inc_metric('plant_labels_total', label=classified_f_label[-1].replace('Classified Label: ', ''))
+    timings['prediction'] = time.perf_counter() - stage
+
+    # Pass 2: enhanced pixels of the detected cluster in every diseased tile
+    stage = time.perf_counter()
+    mask_map = np.lib.format.open_memmap(paths['mask'], mode='w+', dtype=bool, shape=(height, width))
+    roi_map = np.lib.format.open_memmap(paths['roi'], mode='w+', dtype=np.uint8, shape=(height, width, 3))
+    disease_map = np.zeros(grid, dtype=np.uint8)
+    area_map = np.zeros(grid, dtype=np.float32)
+    diseased = 0
+    for idx, (rows, cols) in enumerate(tiles):
+        tile_pos = (rows.start // tile_size, cols.start // tile_size)
+        disease_map[tile_pos] = TILE_LABELS.index(classified_f_label[idx])
+        if len(classified_f[idx]) == 0:
+            continue
+        mask = get_classified_mask(centers_u8[label_map[rows, cols]], classified_f[idx])
+        enh_tile = enhancement(np.ascontiguousarray(inp_img[rows, cols]), swap_rb=True)
+        mask_map[rows, cols] = mask
+        np.copyto(roi_map[rows, cols], enh_tile, where=mask[:,:,np.newaxis])
+        area = int(np.count_nonzero(mask))
+        area_map[tile_pos] = area / float(mask.size)
+        diseased += area
+    for raster in (label_map, mask_map, roi_map):
+        raster.flush()
+    np.save(paths['disease_map'], disease_map)
+    np.save(paths['area_map'], area_map)
+    timings['region'] = time.perf_counter() - stage
+    timings['total'] = time.perf_counter() - start
+
+    return {
+        'label': classified_f_label[-1],
+        'feature': classified_f[-1],
+        'height': height,
+        'width': width,
+        'area': {'pixels': diseased, 'fraction': diseased / float(height * width)},
+        'tile_size': tile_size,
+        'disease_map': disease_map,
+        'area_map': area_map,
+        'tile_labels': {label: int(np.count_nonzero(disease_map == code)) for code, label in enumerate(TILE_LABELS)},
+        'paths': paths,
+        'timings': timings,
+    }
+
+# ====================================================================================================
+# Stream Processing
+# Per-frame labels of a video file or camera device read with cv.VideoCapture. The segmentation of a
+# frame is warm-started from the centers of the previous processed frame (single K-Means attempt);
+# the first frame and every STREAM_RESEED_EVERY-th processed frame are clustered cold. Only the label
+# path runs (HSV -> segmentation -> features -> prediction), frames are not enhanced or rendered.
+# With target_fps, frames are grabbed without decoding and skipped until their stream time reaches
+# the next due time (1 / target_fps after the last processed frame). In realtime mode (the default
+# for camera devices) the due time also never falls behind the wall clock, so frames that arrived
+# while a slow frame was processed are dropped instead of queueing up. max_side downscales frames
+# (longest side in pixels) before processing.
+# o/p: generator of one dict per processed frame, including the running throughput
+# ----------------------------------------------------------------------------------------------------
+STREAM_RESEED_EVERY = int(os.environ.get('STREAM_RESEED_EVERY', 100))
+STREAM_MAX_SIDE = int(os.environ.get('STREAM_MAX_SIDE', 0))
+
+def classify_frame(frame, seg_mode=None, init_centers=None):
+    hsv_cmap = cv.cvtColor(frame, cv.COLOR_RGB2HSV)
+    seg_img, seg_lbl, centers = segmentation_process(hsv_cmap, mode=seg_mode, init_centers=init_centers, return_centers=True)
+    feature_set, feature_df = get_features([seg_img], [seg_lbl], as_frame=False)
+    classified_f, classified_f_label = prediction(feature_set, feature_df)
+
+    return classified_f_label[0], classified_f[0], centers
+
+def stream_frames(source, target_fps=None, seg_mode=None, max_frames=None, max_side=None, reseed_every=None, realtime=None):
+    cap = cv.VideoCapture(source)
+    if not cap.isOpened():
+        raise ValueError('could not open the video source %s' % (source,))
+    device = isinstance(source, int)
+    if device:
+        # keep only the newest frame in the driver queue
+        cap.set(cv.CAP_PROP_BUFFERSIZE, 1)
+    realtime = device if realtime is None else realtime
+    source_fps = cap.get(cv.CAP_PROP_FPS) or 0.0
+    max_side = STREAM_MAX_SIDE if max_side is None else max_side
+    reseed_every = STREAM_RESEED_EVERY if reseed_every is None else reseed_every
+    interval = 1.0 / target_fps if target_fps else 0.0
+
+    centers = None
+    frame_idx = -1
+    processed = skipped = 0
+    next_due = 0.0
+    start = time.perf_counter()
+    try:
+        while max_frames is None or processed < max_frames:
+            if not cap.grab():
+                break
+            frame_idx += 1
+            if device:
+                stream_time = time.perf_counter() - start
+            elif source_fps > 0:
+                stream_time = frame_idx / source_fps
+            else:
+                stream_time = cap.get(cv.CAP_PROP_POS_MSEC) / 1000.0
+            if stream_time < next_due:
+                skipped += 1
+                continue
+            ok, frame = cap.retrieve()
+            if not ok:
+                break
+
+            stage = time.perf_counter()
+            if max_side and max(frame.shape[:2]) > max_side:
+                scale = max_side / float(max(frame.shape[:2]))
+                frame = cv.resize(frame, (max(1, int(frame.shape[1] * scale)), max(1, int(frame.shape[0] * scale))), interpolation=cv.INTER_AREA)
+            warm = centers is not None and (reseed_every <= 0 or processed % reseed_every != 0)
+            label, feature, centers = classify_frame(frame, seg_mode=seg_mode, init_centers=centers if warm else None)
+            processed += 1
+            now = time.perf_counter()
+
+            next_due = stream_time + interval
+            if realtime:
+                next_due = max(next_due, now - start)
+
+            yield {
+                'frame': frame_idx,
+                'time': stream_time,
+                'label': label,
+                'feature': feature,
+                'warm': warm,
+                'latency': now - stage,
+                'processed': processed,
+                'skipped': skipped,
+                'fps': processed / (now - start),
+            }
+    finally:
+        cap.release()
+
+# ====================================================================================================
+# Result Cache
+# Content-addressed LRU cache of detection results keyed by the SHA-256 of the uploaded bytes, the
+# model version and the settings that change a result: segmentation mode, pre-screen (PRESCREEN) and
+# render backend. Entries older than RESULT_CACHE_MAX_AGE seconds are
+# dropped on lookup, the least recently used entry is evicted beyond RESULT_CACHE_SIZE entries
+# (0 disables the cache). A lookup may pass a validity check, e.g. that the rendered file still exists.
+# ----------------------------------------------------------------------------------------------------
+RESULT_CACHE_SIZE = int(os.environ.get('RESULT_CACHE_SIZE', 256))
+RESULT_CACHE_MAX_AGE = float(os.environ.get('RESULT_CACHE_MAX_AGE', 24 * 3600))
+
+_RESULT_CACHE = OrderedDict()
+_RESULT_CACHE_LOCK = threading.Lock()
+_RESULT_CACHE_STATS = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def result_cache_key(data, seg_mode=None, prescreen=None, render_backend=None):
+    prescreen = PRESCREEN if prescreen is None else prescreen
+    return ':'.join((hashlib.sha256(data).hexdigest(), model_version(), seg_mode or SEGMENTATION_MODE,
+                     'prescreen' if prescreen else 'no-prescreen', render_backend or RENDER_BACKEND))
+
+def result_cache_get(key, valid=None):
+    with _RESULT_CACHE_LOCK:
+        entry = _RESULT_CACHE.get(key)
+        if entry is not None:
+            expired = time.time() - entry['stored_at'] > RESULT_CACHE_MAX_AGE
+            if expired or (valid is not None and not valid(entry['value'])):
+                del _RESULT_CACHE[key]
+                _RESULT_CACHE_STATS['evictions'] += 1
+                entry = None
+        if entry is None:
+            _RESULT_CACHE_STATS['misses'] += 1
+            return None
+
+        _RESULT_CACHE.move_to_end(key)
+        _RESULT_CACHE_STATS['hits'] += 1
+
+        return entry['value']
+
+def result_cache_put(key, value):
+    if RESULT_CACHE_SIZE <= 0:
+        return
+
+    with _RESULT_CACHE_LOCK:
+        _RESULT_CACHE[key] = {'value': value, 'stored_at': time.time()}
+        _RESULT_CACHE.move_to_end(key)
+        while len(_RESULT_CACHE) > RESULT_CACHE_SIZE:
+            _RESULT_CACHE.popitem(last=False)
+            _RESULT_CACHE_STATS['evictions'] += 1
+
+def result_cache_stats():
+    with _RESULT_CACHE_LOCK:
+        stats = dict(_RESULT_CACHE_STATS)
+        stats['size'] = len(_RESULT_CACHE)
+    stats['max_size'] = RESULT_CACHE_SIZE
+    stats['max_age'] = RESULT_CACHE_MAX_AGE
+
+    return stats
+
+# ====================================================================================================
+# Result Store
+# Rendered result images in PRED_FOLDER, capped at RESULT_STORE_MAX_FILES files and
+# RESULT_STORE_MAX_BYTES bytes; the least recently viewed results are deleted first. The most
+# recently viewed images are also kept in memory up to RESULT_STORE_MEMORY bytes (0 = off). Every
+# image carries an ETag (SHA-256 prefix of its bytes) for conditional GETs. The folder is the source
+# of truth, so the caps hold for PRED_FOLDER as a whole with several worker processes (serve.py
+# --workers) or batch runs writing into it: the index is rebuilt from the files in PRED_FOLDER
+# whenever the folder's mtime changes (a file added or deleted by any process), and viewing a result
+# touches its file, so the files' mtime order is the least recently viewed order of all processes.
+# ----------------------------------------------------------------------------------------------------
+RESULT_STORE_MAX_FILES = int(os.environ.get('RESULT_STORE_MAX_FILES', 2000))
+RESULT_STORE_MAX_BYTES = int(os.environ.get('RESULT_STORE_MAX_BYTES', 512 << 20))
+RESULT_STORE_MEMORY = int(os.environ.get('RESULT_STORE_MEMORY', 32 << 20))
+# Cache-Control max-age (seconds) of served result images; a result name never changes its image
+RESULT_IMAGE_MAX_AGE = int(os.environ.get('RESULT_IMAGE_MAX_AGE', 24 * 3600))
+
+_RESULT_STORE = {'folder': None, 'mtime': None, 'index': OrderedDict(), 'bytes': 0, 'hot': OrderedDict(), 'hot_bytes': 0}
+_RESULT_STORE_LOCK = threading.Lock()
+_RESULT_STORE_STATS = {'stored': 0, 'hits': 0, 'memory_hits': 0, 'misses': 0, 'evictions': 0}
+
+def _result_path(name):
+    return os.path.join(PRED_FOLDER, name + '.png')
+
+# (Re)build the index when PRED_FOLDER or its content changed, least recently viewed file first.
+# ETags and in-memory images of unchanged files are kept. Called with the lock held.
+def _result_store_index():
+    try:
+        folder_mtime = os.stat(PRED_FOLDER).st_mtime_ns
+    except OSError:
+        folder_mtime = None
+    if _RESULT_STORE['folder'] == PRED_FOLDER and _RESULT_STORE['mtime'] == folder_mtime:
+        return _RESULT_STORE['index']
+
+    if _RESULT_STORE['folder'] != PRED_FOLDER:
+        _RESULT_STORE.update(index=OrderedDict(), hot=OrderedDict(), hot_bytes=0)
+    files = []
+    if folder_mtime is not None:
+        for entry in os.scandir(PRED_FOLDER):
+            if entry.name.endswith('.png'):
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    # deleted by another process while scanning
+                    continue
+                files.append((stat.st_mtime_ns, entry.name[:-4], stat.st_size))
+    old_index, old_hot = _RESULT_STORE['index'], _RESULT_STORE['hot']
+    index, hot = OrderedDict(), OrderedDict()
+    for mtime, name, size in sorted(files):
+        old_item = old_index.get(name)
+        index[name] = old_item if old_item is not None and old_item['size'] == size else {'size': size, 'etag': None}
+    for name, png in old_hot.items():
+        if name in index and index[name]['etag'] is not None:
+            hot[name] = png
+    _RESULT_STORE.update(folder=PRED_FOLDER, mtime=folder_mtime, index=index, bytes=sum(item['size'] for item in index.values()),
+                         hot=hot, hot_bytes=sum(len(png) for png in hot.values()))
+
+    return index
+
+# Mark a result as viewed for every process: the index is ordered by file mtime when rebuilt
+def _touch_result(name):
+    try:
+        os.utime(_result_path(name))
+    except OSError:
+        pass
+
+def _drop_result(name):
+    item = _RESULT_STORE['index'].pop(name, None)
+    if item is not None:
+        _RESULT_STORE['bytes'] -= item['size']
+    png = _RESULT_STORE['hot'].pop(name, None)
+    if png is not None:
+        _RESULT_STORE['hot_bytes'] -= len(png)
+
+def _hot_put(name, png):
+    if len(png) > RESULT_STORE_MEMORY:
+        return
+    if name in _RESULT_STORE['hot']:
+        _RESULT_STORE['hot'].move_to_end(name)
+        return
+    _RESULT_STORE['hot'][name] = png
+    _RESULT_STORE['hot_bytes'] += len(png)
+    while _RESULT_STORE['hot_bytes'] > RESULT_STORE_MEMORY:
+        old_name, old_png = _RESULT_STORE['hot'].popitem(last=False)
+        _RESULT_STORE['hot_bytes'] -= len(old_png)
+
+def store_result(name, png):
+    path = _result_path(name)
+    tmp_path = path + '.' + uuid.uuid4().hex[:8] + '.tmp'
+    with open(tmp_path, 'wb') as png_file:
+        png_file.write(png)
+    os.replace(tmp_path, path)
+
+    evicted = []
+    with _RESULT_STORE_LOCK:
+        index = _result_store_index()
+        _drop_result(name)
+        index[name] = {'size': len(png), 'etag': hashlib.sha256(png).hexdigest()[:32]}
+        _RESULT_STORE['bytes'] += len(png)
+        _hot_put(name, png)
+        _RESULT_STORE_STATS['stored'] += 1
+        while len(index) > 1 and (len(index) > RESULT_STORE_MAX_FILES or _RESULT_STORE['bytes'] > RESULT_STORE_MAX_BYTES):
+            old_name = next(iter(index))
+            _drop_result(old_name)
+            evicted.append(old_name)
+        _RESULT_STORE_STATS['evictions'] += len(evicted)
+
+    for old_name in evicted:
+        try:
+            os.remove(_result_path(old_name))
+        except OSError:
+            pass
+
+    return index[name]['etag']
+
+def has_result(name):
+    with _RESULT_STORE_LOCK:
+        return name in _result_store_index() and os.path.exists(_result_path(name))
+
+# o/p: (png bytes, etag) or None when the result is unknown or was evicted
+def load_result(name):
+    with _RESULT_STORE_LOCK:
+        index = _result_store_index()
+        item = index.get(name)
+        if item is not None:
+            index.move_to_end(name)
+            png = _RESULT_STORE['hot'].get(name)
+            if png is not None and item['etag'] is not None:
+                _RESULT_STORE['hot'].move_to_end(name)
+                _RESULT_STORE_STATS['hits'] += 1
+                _RESULT_STORE_STATS['memory_hits'] += 1
+                _touch_result(name)
+                return png, item['etag']
+
+    try:
+        with open(_result_path(name), 'rb') as png_file:
+            png = png_file.read()
+    except (OSError, ValueError):
+        png = None
+
+    with _RESULT_STORE_LOCK:
+        if png is None:
+            _drop_result(name)
+            _RESULT_STORE_STATS['misses'] += 1
+            return None
+        index = _result_store_index()
+        if name not in index:
+            # written by another process (e.g. a batch run into PRED_FOLDER) since the index was built
+            index[name] = {'size': len(png), 'etag': None}
+            _RESULT_STORE['bytes'] += len(png)
+        item = index[name]
+        if item['etag'] is None:
+            item['etag'] = hashlib.sha256(png).hexdigest()[:32]
+        _hot_put(name, png)
+        _RESULT_STORE_STATS['hits'] += 1
+    _touch_result(name)
+
+    return png, item['etag']
+
+def result_store_stats():
+    with _RESULT_STORE_LOCK:
+        _result_store_index()
+        stats = dict(_RESULT_STORE_STATS)
+        stats.update(files=len(_RESULT_STORE['index']), bytes=_RESULT_STORE['bytes'], memory_files=len(_RESULT_STORE['hot']),
+                     memory_bytes=_RESULT_STORE['hot_bytes'])
+    stats.update(max_files=RESULT_STORE_MAX_FILES, max_bytes=RESULT_STORE_MAX_BYTES, max_memory=RESULT_STORE_MEMORY)
+
+    return stats
+
+# ====================================================================================================
+# Submission: store the upload, return the cached result or run the detection pipeline and render it
+# Everything a submission writes is request scoped: the result image and the persisted upload carry a
+# random request id, so concurrent uploads with the same file name never overwrite each other.
+# o/p: {'result_name', 'label', 'cached', 'height', 'width', 'timings'}, result_name is the page name
+# under /result
+# ----------------------------------------------------------------------------------------------------
+UPLOAD_FOLDER = './UPLOAD_FOLDER/'
+PRED_FOLDER = './static/PRED_FOLDER/'
+
+# Uploads are decoded in memory; with PERSIST_UPLOADS=1 they are also written to UPLOAD_FOLDER by a
+# background thread for auditing, off the request path
+PERSIST_UPLOADS = os.environ.get('PERSIST_UPLOADS', '0') == '1'
+
+_PERSIST_LOCK = threading.Lock()
+_PERSIST_EXECUTOR = None
+
+def _write_upload(data, filename):
+    try:
+        with open(os.path.join(UPLOAD_FOLDER, filename), 'wb') as upload_file:
+            upload_file.write(data)
+    except OSError as err:
+        logger.warning('Could not persist upload %s: %s', filename, err)
+
+def persist_upload(data, filename):
+    global _PERSIST_EXECUTOR
+    with _PERSIST_LOCK:
+        if _PERSIST_EXECUTOR is None:
+            _PERSIST_EXECUTOR = ThreadPoolExecutor(max_workers=1, thread_name_prefix='upload-writer')
+
+    return _PERSIST_EXECUTOR.submit(_write_upload, data, filename)
+
+def run_submission(data, filename):
+    request_id = uuid.uuid4().hex[:12]
+    if PERSIST_UPLOADS:
+        persist_upload(data, request_id + '_' + filename)
+
+    # Same bytes and model as an earlier upload: return its stored result without recomputing
+    cache_key = result_cache_key(data)
+    cached = result_cache_get(cache_key, valid=lambda value: not value['rendered'] or has_result(value['result_name']))
+    if cached is not None:
+        logger.debug('Cached result %s: %s', cached['result_name'], cached['label'])
+        return {'result_name': cached['result_name'], 'label': cached['label'], 'cached': True, 'height': cached['height'],
+                'width': cached['width'], 'timings': {}}
+
+    # The result's images are leased pooled buffers, returned to the pool once the result is rendered
+    pool = lease_buffers()
+    try:
+        result = detect(decode_image(data), pool=pool)
+        png = render_result(result, pool=pool)
+    finally:
+        if pool is not None:
+            pool.release()
+
+    result_name = 'pred_outcome_' + filename[:len(filename)-4] + '_' + request_id
+    if png is not None:
+        store_result(result_name, png)
+
+    result_cache_put(cache_key, {
+        'label': result['label'],
+        'feature': result['feature'],
+        'features': result['features'],
+        'result_name': result_name,
+        'rendered': png is not None,
+        'height': result['height'],
+        'width': result['width'],
+    })
+
+    return {'result_name': result_name, 'label': result['label'], 'cached': False, 'height': result['height'], 'width': result['width'],
+            'timings': result['timings']}
+
+# ====================================================================================================
+# Asynchronous Jobs
+# Submissions are queued to a bounded pool of JOB_WORKERS threads (started on first use). At most
+# JOB_QUEUE_SIZE jobs wait in the queue, beyond that submit_job refuses the job. The status of the
+# last JOB_HISTORY jobs is kept for polling, with per-job queue wait and run time.
+# A job runs in the process that accepted it, but every status change is also written (atomically)
+# to JOB_FOLDER/<id>.json, so with several server processes (serve.py --workers) a poll answered by
+# another worker reads the job from there. JOB_FOLDER keeps the newest JOB_HISTORY job files.
+# ----------------------------------------------------------------------------------------------------
+ASYNC_SUBMIT = os.environ.get('ASYNC_SUBMIT', '0') == '1'
+JOB_WORKERS = int(os.environ.get('JOB_WORKERS', 2))
+JOB_QUEUE_SIZE = int(os.environ.get('JOB_QUEUE_SIZE', 16))
+JOB_FOLDER = os.environ.get('JOB_FOLDER', './jobs/')
+JOB_HISTORY = 1000
+
+_JOBS = OrderedDict()
+_JOB_LOCK = threading.Lock()
+_JOB_QUEUE = queue.Queue(maxsize=JOB_QUEUE_SIZE)
+_JOB_THREADS = []
+_JOB_THREAD_IDS = itertools.count()
+
+def _job_path(job_id):
+    return os.path.join(JOB_FOLDER, job_id + '.json')
+
+# Public status of a job (without its task) as written to JOB_FOLDER; called under _JOB_LOCK
+def _job_snapshot(job):
+    status = {key: value for key, value in job.items() if key != 'task'}
+    status['worker_pid'] = os.getpid()
+    status['queue_depth'] = _JOB_QUEUE.qsize()
+    return status
+
+def _write_job(job):
+    os.makedirs(JOB_FOLDER, exist_ok=True)
+    path = _job_path(job['id'])
+    with open(path + '.tmp', 'w') as job_file:
+        json.dump(_job_snapshot(job), job_file)
+    os.replace(path + '.tmp', path)
+
+# Status update of a running job; on a write error the job goes on, its status stays in memory
+def _save_job(job):
+    try:
+        _write_job(job)
+    except OSError as err:
+        logger.error('Could not write the status of job %s: %s', job['id'], err)
+
+# Delete the oldest job files beyond JOB_HISTORY (written by any worker)
+def _prune_job_files():
+    try:
+        names = [name for name in os.listdir(JOB_FOLDER) if name.endswith('.json')]
+    except OSError:
+        return
+    if len(names) <= JOB_HISTORY:
+        return
+    aged = []
+    for name in names:
+        try:
+            aged.append((os.path.getmtime(os.path.join(JOB_FOLDER, name)), name))
+        except OSError:
+            pass
+    for mtime, name in sorted(aged)[:max(0, len(aged) - JOB_HISTORY)]:
+        try:
+            os.remove(os.path.join(JOB_FOLDER, name))
+        except OSError:
+            pass
+
+# Every change of a job's fields is applied under _JOB_LOCK in one update, with the status last, so a
+# poll never sees a half-updated job (e.g. done without its timings)
+def _job_worker():
+    while True:
+        job_id = _JOB_QUEUE.get()
+        try:
+            _run_job(job_id)
+        finally:
+            _JOB_QUEUE.task_done()
+
+def _run_job(job_id):
+    with _JOB_LOCK:
+        job = _JOBS.get(job_id)
+        if job is None:
+            return
+        task = job.pop('task')
+        started_at = time.time()
+        job.update({'started_at': started_at, 'status': 'running'})
+        _save_job(job)
+
+    finished = {}
+    try:
+        outcome = task()
+        finished['result_name'] = outcome['result_name']
+        finished['label'] = outcome['label']
+        finished['cached'] = outcome['cached']
+        if 'profile_id' in outcome:
+            finished['profile_id'] = outcome['profile_id']
+        finished['timings'] = dict(outcome['timings'])
+        status = 'done'
+    except Exception as err:
+        finished['timings'] = {}
+        finished['error'] = repr(err)
+        status = 'failed'
+    finished['finished_at'] = time.time()
+    finished['timings']['queued'] = started_at - job['submitted_at']
+    finished['timings']['run'] = finished['finished_at'] - started_at
+    finished['status'] = status
+    with _JOB_LOCK:
+        job.update(finished)
+        _save_job(job)
+
+# Starts the missing job workers, replacing any that died
+def _start_job_workers():
+    with _JOB_LOCK:
+        _JOB_THREADS[:] = [worker for worker in _JOB_THREADS if worker.is_alive()]
+        while len(_JOB_THREADS) < JOB_WORKERS:
+            worker = threading.Thread(target=_job_worker, name='job-worker-%d' % next(_JOB_THREAD_IDS), daemon=True)
+            worker.start()
+            _JOB_THREADS.append(worker)
+
+def submit_job(task):
+    _start_job_workers()
+    job = {'id': uuid.uuid4().hex, 'status': 'queued', 'submitted_at': time.time(), 'task': task}
+    with _JOB_LOCK:
+        # Only submit_job adds to the queue, under the lock, so a queue that is not full keeps room for
+        # the job. Its status file is written before it is queued: when the write fails nothing runs.
+        if _JOB_QUEUE.full():
+            return None
+        _write_job(job)
+        _JOB_QUEUE.put_nowait(job['id'])
+        _JOBS[job['id']] = job
+        # Forget the oldest finished jobs beyond JOB_HISTORY
+        for job_id in list(_JOBS):
+            if len(_JOBS) <= JOB_HISTORY:
+                break
+            if _JOBS[job_id]['status'] in ('done', 'failed'):
+                del _JOBS[job_id]
+    _prune_job_files()
+
+    return job['id']
+
+# Status of a job of this process, or read from JOB_FOLDER for a job of another worker process.
+# queue_depth is the depth of the queue of the worker running the job (as of its last status change).
+def job_status(job_id):
+    with _JOB_LOCK:
+        job = _JOBS.get(job_id)
+        if job is not None:
+            return _job_snapshot(job)
+
+    # Job ids are uuid4 hex strings; anything else cannot name a job file
+    if len(job_id) != 32 or not all(char in '0123456789abcdef' for char in job_id):
+        return None
+    try:
+        with open(_job_path(job_id)) as job_file:
+            status = json.load(job_file)
+    except (OSError, ValueError):
+        return None
+
+    return status
+
+# ====================================================================================================
+# Concurrency Limit
+# At most MAX_CONCURRENT pipeline requests (/submit, /api/predict) run at once in a server process
+# (0 = no limit). A request waits up to CONCURRENCY_TIMEOUT seconds for a free slot and is answered
+# with 503 and Retry-After otherwise, instead of piling more threads onto the same cores.
+# ----------------------------------------------------------------------------------------------------
+MAX_CONCURRENT = int(os.environ.get('MAX_CONCURRENT', 0))
+CONCURRENCY_TIMEOUT = float(os.environ.get('CONCURRENCY_TIMEOUT', 30))
+
+_CONCURRENCY_LOCK = threading.Lock()
+_CONCURRENCY = {'slots': None, 'limit': None, 'active': 0, 'rejected': 0}
+
+def _concurrency_slots():
+    with _CONCURRENCY_LOCK:
+        if _CONCURRENCY['limit'] != MAX_CONCURRENT:
+            _CONCURRENCY['slots'] = threading.BoundedSemaphore(MAX_CONCURRENT) if MAX_CONCURRENT > 0 else None
+            _CONCURRENCY['limit'] = MAX_CONCURRENT
+
+    return _CONCURRENCY['slots']
+
+def limit_concurrency(view):
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        slots = _concurrency_slots()
+        if slots is None:
+            return view(*args, **kwargs)
+        if not slots.acquire(timeout=CONCURRENCY_TIMEOUT):
+            with _CONCURRENCY_LOCK:
+                _CONCURRENCY['rejected'] += 1
+            return jsonify({'error': 'server busy', 'max_concurrent': MAX_CONCURRENT}), 503, {'Retry-After': '5'}
+        with _CONCURRENCY_LOCK:
+            _CONCURRENCY['active'] += 1
+        try:
+            return view(*args, **kwargs)
+        finally:
+            with _CONCURRENCY_LOCK:
+                _CONCURRENCY['active'] -= 1
+            slots.release()
+
+    return wrapper
+
+# ====================================================================================================
+# Request Profiling
+# A submission runs under cProfile when its request carries the PROFILE_HEADER header with the
+# PROFILE_TOKEN value, or at random with probability PROFILE_RATE. One submission per process is
+# profiled at a time; another one arriving meanwhile runs unprofiled (counted as busy). The profile
+# (pstats format, <id>.prof) and its metadata (<id>.json: file name, image size, label, stage timings
+# and the top functions by cumulative time) are saved to PROFILE_FOLDER, which keeps the newest
+# PROFILE_MAX_FILES profiles. /profiles lists them and /profiles/<id>.prof|.json downloads them; both
+# need the token (header or ?token=). With no token and PROFILE_RATE=0 profiling is off and a request
+# only checks these two settings.
+# ----------------------------------------------------------------------------------------------------
+PROFILE_FOLDER = os.environ.get('PROFILE_FOLDER', './profiles/')
+PROFILE_TOKEN = os.environ.get('PROFILE_TOKEN', '')
+PROFILE_RATE = float(os.environ.get('PROFILE_RATE', 0))
+PROFILE_MAX_FILES = int(os.environ.get('PROFILE_MAX_FILES', 50))
+PROFILE_HEADER = 'X-Profile'
+PROFILE_TOP_FUNCTIONS = 25
+
+_PROFILE_LOCK = threading.Lock()
+
+def profile_authorized(token):
+    return bool(PROFILE_TOKEN) and token is not None and hmac.compare_digest(token, PROFILE_TOKEN)
+
+# Trigger of a request's profile: 'header', 'rate' or None (not profiled)
+def profile_trigger(headers):
+    if profile_authorized(headers.get(PROFILE_HEADER)):
+        return 'header'
+    if PROFILE_RATE > 0 and np.random.random() < PROFILE_RATE:
+        return 'rate'
+
+    return None
+
+# Functions with the largest cumulative time of a profile
+def _top_functions(stats, limit=None):
+    rows = sorted(stats.stats.items(), key=lambda item: item[1][3], reverse=True)[:limit or PROFILE_TOP_FUNCTIONS]
+    top = []
+    for (filename, line, func), (cc, nc, tt, ct, callers) in rows:
+        top.append({'function': '%s:%d(%s)' % (filename, line, func), 'calls': nc, 'tottime': tt, 'cumtime': ct})
+
+    return top
+
+def save_profile(profiler, meta):
+    import pstats
+
+    os.makedirs(PROFILE_FOLDER, exist_ok=True)
+    stats = pstats.Stats(profiler)
+    meta['top_functions'] = _top_functions(stats)
+    base = os.path.join(PROFILE_FOLDER, meta['id'])
+    stats.dump_stats(base + '.prof.tmp')
+    os.replace(base + '.prof.tmp', base + '.prof')
+    with open(base + '.json.tmp', 'w') as meta_file:
+        json.dump(meta, meta_file, indent=2)
+    os.replace(base + '.json.tmp', base + '.json')
+
+    # Keep the newest PROFILE_MAX_FILES profiles (ids start with their UTC timestamp)
+    profile_ids = sorted(name[:-5] for name in os.listdir(PROFILE_FOLDER) if name.endswith('.json'))
+    for profile_id in profile_ids[:max(0, len(profile_ids) - PROFILE_MAX_FILES)]:
+        for ext in ('.prof', '.json'):
+            try:
+                os.remove(os.path.join(PROFILE_FOLDER, profile_id + ext))
+            except OSError:
+                pass
+
+# ====================================================================================================
+# Run a submission under cProfile and save its profile, o/p: run_submission outcome with 'profile_id'
+# (None when another profile was running)
+# ----------------------------------------------------------------------------------------------------
+def profile_submission(data, filename, trigger):
+    import cProfile
+
+    if not _PROFILE_LOCK.acquire(blocking=False):
+        inc_metric('plant_profiles_total', trigger='busy')
+        outcome = run_submission(data, filename)
+        outcome['profile_id'] = None
+        return outcome
+
+    profile_id = time.strftime('%Y%m%dT%H%M%SZ', time.gmtime()) + '_' + uuid.uuid4().hex[:8]
+    profiler = cProfile.Profile()
+    try:
+        start = time.perf_counter()
+        profiler.enable()
+        try:
+            outcome = run_submission(data, filename)
+        finally:
+            profiler.disable()
+        elapsed = time.perf_counter() - start
+    finally:
+        _PROFILE_LOCK.release()
+    inc_metric('plant_profiles_total', trigger=trigger)
+
+    save_profile(profiler, {
+        'id': profile_id,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'trigger': trigger,
+        'filename': filename,
+        'bytes': len(data),
+        'height': outcome['height'],
+        'width': outcome['width'],
+        'label': outcome['label'],
+        'cached': outcome['cached'],
+        'result_name': outcome['result_name'],
+        'seconds': elapsed,
+        'timings': outcome['timings'],
+        'segmentation': SEGMENTATION_MODE,
+        'model_version': model_version(),
+    })
+    logger.info('Profiled %s in %.3f s: %s', filename, elapsed, profile_id)
+    outcome['profile_id'] = profile_id
+
+    return outcome
+
+def list_profiles():
+    if not os.path.isdir(PROFILE_FOLDER):
+        return []
+    profiles = []
+    for name in sorted(os.listdir(PROFILE_FOLDER), reverse=True):
+        if not name.endswith('.json'):
+            continue
+        try:
+            with open(os.path.join(PROFILE_FOLDER, name)) as meta_file:
+                meta = json.load(meta_file)
+        except (OSError, ValueError):
+            continue
+        meta.pop('top_functions', None)
+        profiles.append(meta)
+
+    return profiles
+
+# ====================================================================================================
+# Startup
+# The classifiers are loaded and warmed with one dummy inference (a small random image through
+# segmentation -> features -> prediction, then enhancement -> render) so the first request does not
+# pay for lazy initialization. STARTUP_WARMUP: 'sync' warms up at import (before a pre-forking server
+# forks), 'background' in a thread while /ready answers 503, 'off' loads on first use.
+# ----------------------------------------------------------------------------------------------------
+STARTUP_WARMUP = os.environ.get('STARTUP_WARMUP', 'sync')
+
+_STARTUP = {'ready': False, 'imports': None, 'models': None, 'warmup': None, 'total': None}
+
+def warmup():
+    start = time.perf_counter()
+    _METRICS_LOCAL.suppressed = True
+    try:
+        load_models()
+        _STARTUP['models'] = time.perf_counter() - start
+
+        dummy = np.random.default_rng(0).integers(0, 256, size=(64, 64, 3), dtype=np.uint8)
+        result = detect(dummy, seg_mode=SEGMENTATION_MODE, prescreen=False, render=False)
+        if RENDER_BACKEND != 'matplotlib':
+            enh_img = enhancement(dummy, swap_rb=True)
+            render_prediction([enh_img, enh_img], ['Input Image', result['label']])
+    finally:
+        _METRICS_LOCAL.suppressed = False
+    _STARTUP['warmup'] = time.perf_counter() - start
+    _STARTUP['total'] = time.perf_counter() - _IMPORT_START
+    _STARTUP['ready'] = True
+    logger.info('Ready in %.3f s (imports %.3f s, models %.3f s, warm-up %.3f s)',
+                _STARTUP['total'], _STARTUP['imports'], _STARTUP['models'], _STARTUP['warmup'])
+
+def startup_report():
+    return dict(_STARTUP)
+
+_STARTUP['imports'] = time.perf_counter() - _IMPORT_START
+if STARTUP_WARMUP == 'sync':
+    warmup()
+elif STARTUP_WARMUP == 'background':
+    threading.Thread(target=warmup, name='warmup', daemon=True).start()
+
 # Section 2
 # FLASK Codes
 # ================================================================================================
 app=Flask(__name__)
 
 
+@app.after_request
+def count_request(response):
+    inc_metric('plant_requests_total', endpoint=request.endpoint or 'unknown', status=str(response.status_code))
+    return response
+
+@app.route("/metrics")
+def metrics():
+    cache_stats = result_cache_stats()
+    store_stats = result_store_stats()
+    pool_stats = buffer_pool_stats()
+    gauges = [
+        ('plant_result_cache_hits', 'Result cache hits since start', cache_stats['hits']),
+        ('plant_result_cache_misses', 'Result cache misses since start', cache_stats['misses']),
+        ('plant_result_cache_entries', 'Entries in the result cache', cache_stats['size']),
+        ('plant_job_queue_depth', 'Jobs waiting in the async job queue', _JOB_QUEUE.qsize()),
+        ('plant_result_store_files', 'Result images in the result store', store_stats['files']),
+        ('plant_result_store_bytes', 'Bytes of result images in the result store', store_stats['bytes']),
+        ('plant_result_store_evictions', 'Result images evicted from the result store since start', store_stats['evictions']),
+        ('plant_active_requests', 'Pipeline requests running in this process', _CONCURRENCY['active']),
+        ('plant_rejected_requests', 'Pipeline requests rejected by the concurrency limit since start', _CONCURRENCY['rejected']),
+        ('plant_buffer_pool_bytes', 'Bytes of idle buffers held by the buffer pool', pool_stats['bytes']),
+        ('plant_buffer_pool_hits', 'Buffers reused from the buffer pool since start', pool_stats['hits']),
+        ('plant_buffer_pool_misses', 'Buffers allocated because the buffer pool had none since start', pool_stats['misses']),
+        ('plant_buffer_pool_dropped_bytes', 'Bytes of idle buffers dropped by the buffer pool since start', pool_stats['dropped_bytes']),
+    ]
+    return Response(render_metrics(gauges), mimetype='text/plain; version=0.0.4')
+
+@app.route("/ready")
+def ready():
+    report = startup_report()
+    return jsonify(report), (200 if report['ready'] or STARTUP_WARMUP == 'off' else 503)
+
 @app.route("/")
 def index():
     return render_template('index.html')
 
+@app.route("/model")
+def model():
+    return jsonify(model_info())
+
+@app.route("/cache")
+def cache():
+    return jsonify(result_cache_stats())
+
 @app.route("/result/<path>")
 def result(path):
-    print(path)
-    image_folder=os.path.join('static','PRED_FOLDER')
-    app.config['PRED_FOLDER']=image_folder
-    pic=os.path.join(app.config['PRED_FOLDER'],path+'.png')
-
-    return render_template('results.html',output_image='/'+pic)
+    logger.debug('Result page %s', path)
+
+    return render_template('results.html',output_image=url_for('result_image', name=path))
+
+# Result image from the result store with an ETag: a repeated view with If-None-Match is answered 304
+@app.route("/results/<name>.png")
+def result_image(name):
+    stored = load_result(secure_filename(name))
+    if stored is None:
+        return jsonify({'error': 'unknown or expired result'}), 404
+
+    png, etag = stored
+    response = Response(png, mimetype='image/png')
+    response.set_etag(etag)
+    response.cache_control.public = True
+    response.cache_control.max_age = RESULT_IMAGE_MAX_AGE
+
+    return response.make_conditional(request)
+
+@app.route("/api/predict",methods=["POST"])
+@limit_concurrency
+def api_predict():
+    # Image as multipart field 'image' or as the raw request body; nothing is rendered or written.
+    # request.files is only touched for multipart bodies: for any other content type (e.g. curl's
+    # default application/x-www-form-urlencoded) it would parse and consume the raw body as a form.
+    if request.mimetype == 'multipart/form-data':
+        if 'image' not in request.files:
+            return jsonify({'error': "multipart request without an 'image' field"}), 400
+        data = request.files['image'].read()
+    else:
+        data = request.get_data()
+    try:
+        inp_img = decode_image(data)
+    except ValueError:
+        return jsonify({'error': 'no decodable image in the request'}), 400
+
+    with_mask = request.args.get('mask') == '1' or (request.mimetype == 'multipart/form-data' and request.form.get('mask') == '1')
+    summary = analyze_image(inp_img, with_mask=with_mask)
+    summary['model_version'] = model_version()
+
+    return jsonify(summary)
+
+@app.route("/jobs/<job_id>")
+def job(job_id):
+    status = job_status(job_id)
+    if status is None:
+        return jsonify({'error': 'unknown job'}), 404
+    if status['status'] == 'done':
+        status['result_url'] = url_for('result', path=status['result_name'])
+        if request.args.get('redirect') == '1':
+            return redirect(status['result_url'])
+
+    return jsonify(status)
 
 @app.route("/submit",methods=["POST","GET"])
+@limit_concurrency
 def submit():
     if request.method=="POST":
         image=request.files["image"]
-        UPLOAD_FOLDER = './UPLOAD_FOLDER/'
-        app.config['UPLOAD_FOLDER'] = UPLOAD_FOLDER
 
         filename = secure_filename(image.filename)
-        image.save(os.path.join(app.config['UPLOAD_FOLDER'], filename))
-        print('\n\n',image,'\n\n',UPLOAD_FOLDER+filename)
-
-        
-        segment_hsv_test_good = []
-        segment_hsv_test_good_label = []
-        enh_image_good_test = []
-
-        enh_img, seg_hsv_cls, seg_hsv_lbl = process(UPLOAD_FOLDER+filename)
-        enh_image_good_test.append(enh_img)
-        segment_hsv_test_good.append(seg_hsv_cls)
-        segment_hsv_test_good_label.append(seg_hsv_lbl)
-
-        classified_good_features = []
-        classified_good_feature_label = []
-        classified_good_seg_hsi = []
-        classified_good_seg_img = []
-
-        # Extract Feature Set of Segmented Test Images 
-        test_good_feature_set, test_good_feature_df = get_features(segment_hsv_test_good, segment_hsv_test_good_label)
-
-        # Classify Test Images
-        classified_good_features, classified_good_feature_label = prediction(test_good_feature_set, test_good_feature_df)
-
-        for idz in range(len(classified_good_features)):
-            if len(classified_good_features[idz]) > 0:
-                seg_grp_img, roi_grp_img = get_classified_region(segment_hsv_test_good[idz], classified_good_features[idz], enh_image_good_test[idz], classified_good_feature_label[idz])
-                classified_good_seg_hsi.append(seg_grp_img)
-                classified_good_seg_img.append(roi_grp_img)
-            if (len(classified_good_features[idz]) == 0) and ('Healthy Image' in classified_good_feature_label[idz]):
-                classified_good_seg_hsi.append([])
-                classified_good_seg_img.append(enh_image_good_test[idz])
-
-            
-        for idx in range(len(classified_good_seg_img)):
-            result_img = []
-            result_img_title = []
-            result_img.append(enh_image_good_test[idx])
-            result_img.append(classified_good_seg_img[idx])
-            result_img_title.append('Input Image')
-            result_img_title.append(classified_good_feature_label[idx])
-            
-            image_path = './static/PRED_FOLDER/pred_outcome_' + filename[:len(filename)-4] + '.png'
-
-            filename = secure_filename(image.filename)
-
-            save_prediction(result_img, result_img_title, image_path)
-
-        print('\n\n Done\n\n', 'FILENAME=',filename)
-
-        print(url_for('result', path='pred_outcome_'+filename[:len(filename)-4]))
+        data = image.read()
+        logger.debug('Upload %s (%d bytes)', image, len(data))
+
+        # Profiling is decided here, so a queued job keeps the decision of its request
+        trigger = profile_trigger(request.headers) if PROFILE_TOKEN or PROFILE_RATE > 0 else None
+        if trigger is not None:
+            task = lambda: profile_submission(data, filename, trigger)
+        else:
+            task = lambda: run_submission(data, filename)
+
+        # Async mode: queue the job and answer at once with its status URL (429 when the queue is full)
+        if ASYNC_SUBMIT or request.values.get('async') == '1':
+            job_id = submit_job(task)
+            if job_id is None:
+                return jsonify({'error': 'job queue is full', 'queue_depth': _JOB_QUEUE.qsize()}), 429, {'Retry-After': '5'}
+            return jsonify({'job_id': job_id, 'status': 'queued', 'status_url': url_for('job', job_id=job_id)}), 202
+
+        outcome = task()
+
+        logger.debug('Done %s: %s (%s)', filename, outcome['label'], url_for('result', path=outcome['result_name']))
+
+        if outcome.get('profile_id'):
+            return url_for('result', path=outcome['result_name']), {'X-Profile-Id': outcome['profile_id']}
+        return url_for('result', path=outcome['result_name'])
 
     return url_for('result',path='pred_outcome_'+filename[:len(filename)-4])
 
+# Saved request profiles (see Request Profiling), only with the profiling token
+def _profile_token():
+    return request.headers.get(PROFILE_HEADER) or request.args.get('token')
+
+@app.route("/profiles")
+def profiles():
+    if not profile_authorized(_profile_token()):
+        return jsonify({'error': 'profiling token required'}), 403
+    return jsonify({'max_files': PROFILE_MAX_FILES, 'profiles': list_profiles()})
+
+@app.route("/profiles/<profile_id>.<ext>")
+def profile_file(profile_id, ext):
+    if not profile_authorized(_profile_token()):
+        return jsonify({'error': 'profiling token required'}), 403
+    if ext not in ('prof', 'json'):
+        return jsonify({'error': 'unknown profile format'}), 404
+    return send_from_directory(os.path.abspath(PROFILE_FOLDER), profile_id + '.' + ext, as_attachment=ext == 'prof')
+
 # Section 3
 # Main Function
 # ================================================================================================
 if __name__=='__main__':
+    logging.basicConfig(level=LOG_LEVEL, format=LOG_FORMAT)
     #app.run(host='192.168.1.29', port=5001, debug=True)
     app.run(debug=True)
\ No newline at end of file
@@ -0,0 +1,187 @@
+# Batch Scoring
+# Runs the detection pipeline (app.detect, rendered with save_prediction when --render is given)
+# over a directory or glob of leaf images with a pool of worker processes and writes one result row
+# per image (CSV or JSONL) as soon as it is finished, with the pipeline stages that ran and their
+# times. Without --render the enhancement stage is skipped. Images already scored successfully in
+# the output file are skipped, so a killed run resumes where it stopped and failed images are retried.
+#
+# Usage:
+#   python batch_score.py "UPLOAD_FOLDER/*" -o results.csv --workers 4
+#   python batch_score.py UPLOAD_FOLDER -o results.jsonl --render ./static/PRED_FOLDER
+# ================================================================================================
+import argparse
+import csv
+import glob
+import hashlib
+import json
+import logging
+import os
+import sys
+import time
+from multiprocessing import Pool
+
+import app
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.png', '.bmp', '.tif', '.tiff', '.webp')
+
+FIELDS = ['path', 'status', 'label', 'feature', 'height', 'width', 'error', 'render', 'stages', 't_decode', 't_prescreen',
+          't_segmentation', 't_features', 't_prediction', 't_enhancement', 't_region', 't_render', 't_total']
+
+# ====================================================================================================
+# Expand directories and glob patterns into a sorted, de-duplicated list of image paths
+# ----------------------------------------------------------------------------------------------------
+def list_images(inputs):
+    paths = []
+    for inp in inputs:
+        if os.path.isdir(inp):
+            matches = [os.path.join(inp, name) for name in os.listdir(inp)]
+        else:
+            matches = glob.glob(inp)
+        for path in sorted(matches):
+            path = os.path.normpath(path)
+            if path.lower().endswith(IMAGE_EXTENSIONS) and os.path.isfile(path) and path not in paths:
+                paths.append(path)
+
+    return paths
+
+# ====================================================================================================
+# Paths already scored successfully in an existing output file. A row cut short by a killed run or
+# an error row is ignored and its image is scored again (the new row is appended after the old one).
+# ----------------------------------------------------------------------------------------------------
+def read_done(output, out_format):
+    done = set()
+    if not os.path.exists(output):
+        return done
+
+    with open(output, newline='') as out_file:
+        if out_format == 'jsonl':
+            for line in out_file:
+                try:
+                    row = json.loads(line)
+                except ValueError:
+                    continue
+                if row.get('status') == 'ok':
+                    done.add(row['path'])
+        else:
+            for row in csv.DictReader(out_file):
+                if row.get('status') == 'ok' and row.get('t_total') is not None:
+                    done.add(row['path'])
+
+    return done
+
+# ====================================================================================================
+# Result image name of an input: stem and extension for reading, plus a hash of the absolute path so
+# download.jpg / download.png or equal names in different directories never share a result image
+# ----------------------------------------------------------------------------------------------------
+def render_name(path):
+    stem, ext = os.path.splitext(os.path.basename(path))
+    digest = hashlib.sha1(os.path.abspath(path).encode('utf-8')).hexdigest()[:8]
+
+    return 'pred_outcome_%s_%s_%s.png' % (stem, ext.lstrip('.').lower(), digest)
+
+# ====================================================================================================
+# Score one image (runs inside a worker process)
+# ----------------------------------------------------------------------------------------------------
+def score_image(task):
+    path, render_dir, seg_mode, prescreen = task
+    row = {'path': path}
+    try:
+        result = app.detect(path, seg_mode=seg_mode, prescreen=prescreen, render=bool(render_dir))
+        if render_dir:
+            name = render_name(path)
+            if app.save_result(result, os.path.join(render_dir, name)):
+                row['render'] = name
+        row['status'] = 'ok'
+        row['label'] = result['label']
+        row['feature'] = ' '.join(str(val) for val in result['feature'])
+        row['height'], row['width'] = result['height'], result['width']
+        row['stages'] = ' '.join(result['stages'])
+        for stage, seconds in result['timings'].items():
+            row['t_' + stage] = round(seconds, 4)
+    except Exception as err:
+        row['status'] = 'error'
+        row['error'] = repr(err)
+
+    return row
+
+# ====================================================================================================
+# Result writers: CSV with a header on a new file, or one JSON object per line
+# ----------------------------------------------------------------------------------------------------
+def _ensure_line_end(output):
+    # A run killed mid-write leaves a partial last line; start the next row on a fresh line
+    if os.path.exists(output) and os.path.getsize(output) > 0:
+        with open(output, 'rb') as out_file:
+            out_file.seek(-1, os.SEEK_END)
+            if out_file.read(1) != b'\n':
+                with open(output, 'ab') as append_file:
+                    append_file.write(b'\n')
+
+def open_writer(output, out_format, resume):
+    if resume:
+        _ensure_line_end(output)
+    new_file = not resume or not os.path.exists(output) or os.path.getsize(output) == 0
+    out_file = open(output, 'a' if resume else 'w', newline='')
+
+    if out_format == 'jsonl':
+        def write(row):
+            out_file.write(json.dumps(row) + '\n')
+            out_file.flush()
+    else:
+        writer = csv.DictWriter(out_file, fieldnames=FIELDS, extrasaction='ignore')
+        if new_file:
+            writer.writeheader()
+        def write(row):
+            writer.writerow(row)
+            out_file.flush()
+
+    return out_file, write
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Score a directory or glob of leaf images for Yellow-Rust disease.')
+    parser.add_argument('inputs', nargs='+', help='image directories or glob patterns, e.g. "UPLOAD_FOLDER/*"')
+    parser.add_argument('-o', '--output', default='batch_results.csv', help='CSV or JSONL result file (default: batch_results.csv)')
+    parser.add_argument('--format', choices=['csv', 'jsonl'], help='output format (default: from the output extension)')
+    parser.add_argument('-w', '--workers', type=int, default=os.cpu_count(), help='worker processes (default: CPU count)')
+    parser.add_argument('--render', metavar='DIR', help='also render pred_outcome_<stem>_<ext>_<path hash>.png result images into DIR')
+    parser.add_argument('--segmentation', choices=['full', 'fast'], help='segmentation mode (default: SEGMENTATION_MODE, i.e. full)')
+    parser.add_argument('--prescreen', action='store_true', help='return clearly healthy leaves from a thumbnail pre-screen (default: PRESCREEN)')
+    parser.add_argument('--no-resume', action='store_true', help='overwrite the output instead of skipping scored images')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=app.LOG_LEVEL, format=app.LOG_FORMAT)
+
+    out_format = args.format or ('jsonl' if args.output.endswith(('.jsonl', '.ndjson')) else 'csv')
+    resume = not args.no_resume
+    if args.render:
+        os.makedirs(args.render, exist_ok=True)
+
+    paths = list_images(args.inputs)
+    done = read_done(args.output, out_format) if resume else set()
+    todo = [path for path in paths if path not in done]
+    workers = max(1, min(args.workers, len(todo) or 1))
+    print('%d images found, %d already scored, %d to score with %d worker(s)' % (len(paths), len(paths) - len(todo), len(todo), workers), file=sys.stderr)
+
+    out_file, write = open_writer(args.output, out_format, resume)
+    tasks = [(path, args.render, args.segmentation, args.prescreen or None) for path in todo]
+    failed = 0
+    pool = Pool(workers) if workers > 1 else None
+    start = time.perf_counter()
+    try:
+        rows = map(score_image, tasks) if pool is None else pool.imap_unordered(score_image, tasks)
+        for count, row in enumerate(rows, 1):
+            write(row)
+            failed += (row['status'] != 'ok')
+            elapsed = time.perf_counter() - start
+            print('[%d/%d] %s: %s (%.2f images/s)' % (count, len(tasks), row['path'], row.get('label', row.get('error')), count / elapsed), file=sys.stderr)
+    finally:
+        out_file.close()
+        if pool is not None:
+            pool.terminate()
+
+    elapsed = time.perf_counter() - start
+    if tasks:
+        print('Scored %d images (%d failed) in %.1f s: %.2f images/s' % (len(tasks), failed, elapsed, len(tasks) / elapsed), file=sys.stderr)
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
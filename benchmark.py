@@ -0,0 +1,329 @@
+# Benchmark Suite
+# Times every pipeline stage (decode, enhancement, segmentation, features, prediction, region, render)
+# and the whole /submit flow through Flask's test client on the bundled images and on synthetic leaf
+# images from 0.3 to 24 megapixels. For each case the median wall time, the peak RSS and the
+# throughput are recorded as JSON, and compared against a stored baseline: a case slower than the
+# baseline by more than --threshold is reported as a regression (exit code 1).
+# --trace-memory also traces the NumPy/OpenCV arrays allocated by one /submit with tracemalloc, with
+# and without the buffer pool (app.BUFFER_POOL).
+#
+# Usage:
+#   python benchmark.py --segmentation fast --save-baseline benchmark_baseline.json
+#   python benchmark.py --segmentation fast --baseline benchmark_baseline.json --threshold 0.2
+#   python benchmark.py --sizes 0.3 1 --no-bundled --repeat 5
+#   python benchmark.py --startup 5 --no-bundled --sizes
+#   python benchmark.py --trace-memory --sizes 1 6 --no-bundled
+# ================================================================================================
+import argparse
+import io
+import json
+import os
+import platform
+import resource
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+import cv2 as cv
+
+import app
+from batch_score import list_images
+
+BUNDLED_IMAGES = ['inp.jpg', 'UPLOAD_FOLDER']
+SYNTHETIC_SIZES = [0.3, 1, 2, 6, 12, 24]
+STAGES = ['decode', 'enhancement', 'segmentation', 'features', 'prediction', 'region', 'render']
+
+# ====================================================================================================
+# Synthetic leaf image: green leaf blades on a dark soil background with yellow-rust pustules,
+# deterministic for a given size. o/p: encoded JPEG bytes
+# ----------------------------------------------------------------------------------------------------
+def synthetic_leaf(megapixels, seed=0):
+    rng = np.random.default_rng(seed)
+    width = int(round(np.sqrt(megapixels * 1e6 * 4 / 3)))
+    height = int(round(megapixels * 1e6 / width))
+    img = np.empty((height, width, 3), dtype=np.uint8)
+    img[:] = (40, 60, 70)
+
+    scale = width / 1000.0
+    for idx in range(12):
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        axes = (int(rng.integers(250, 500) * scale), int(rng.integers(25, 60) * scale))
+        color = (int(rng.integers(30, 60)), int(rng.integers(120, 180)), int(rng.integers(40, 90)))
+        cv.ellipse(img, center, axes, float(rng.integers(0, 180)), 0, 360, color, -1)
+
+    leaf = (img[:,:,1] > 100)
+    ys, xs = np.nonzero(leaf[::8, ::8])
+    for pick in rng.choice(len(ys), size=min(len(ys), 1500), replace=False):
+        color = (int(rng.integers(20, 50)), int(rng.integers(140, 190)), int(rng.integers(200, 240)))
+        center = (int(xs[pick] * 8 + rng.integers(0, 8)), int(ys[pick] * 8 + rng.integers(0, 8)))
+        cv.circle(img, center, max(1, int(rng.integers(2, 6) * scale)), color, -1)
+
+    noise = rng.integers(-8, 9, size=img.shape, dtype=np.int16)
+    img = np.clip(img.astype(np.int16) + noise, 0, 255).astype(np.uint8)
+    ok, jpg = cv.imencode('.jpg', img, [cv.IMWRITE_JPEG_QUALITY, 90])
+
+    return jpg.tobytes()
+
+# ====================================================================================================
+# Peak RSS: the kernel's high-water mark is reset before each case where Linux allows it
+# (/proc/self/clear_refs), otherwise the process-wide maximum is reported.
+# ----------------------------------------------------------------------------------------------------
+def reset_peak_rss():
+    try:
+        with open('/proc/self/clear_refs', 'w') as refs:
+            refs.write('5')
+        return True
+    except OSError:
+        return False
+
+def peak_rss_mb():
+    try:
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) / 1024.0
+    except OSError:
+        pass
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    return maxrss / (1024.0 * 1024.0) if sys.platform == 'darwin' else maxrss / 1024.0
+
+# ====================================================================================================
+# One pass over the pipeline stages, o/p: {stage: seconds}
+# ----------------------------------------------------------------------------------------------------
+def time_stages(data, seg_mode, render_path):
+    timings = {}
+
+    start = time.perf_counter()
+    inp_img = app.decode_image(data)
+    timings['decode'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    enh_img = app.enhancement(cv.cvtColor(inp_img, cv.COLOR_BGR2RGB))
+    timings['enhancement'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    seg_img, seg_lbl = app.segmentation_process(cv.cvtColor(inp_img, cv.COLOR_RGB2HSV), mode=seg_mode)
+    timings['segmentation'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    feature_set, feature_df = app.get_features([seg_img], [seg_lbl], as_frame=False)
+    timings['features'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    classified_f, classified_f_label = app.prediction(feature_set, feature_df)
+    timings['prediction'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    roi_img = enh_img
+    if len(classified_f[0]) > 0:
+        seg_grp_img, roi_img = app.get_classified_region(seg_img, classified_f[0], enh_img, classified_f_label[0])
+    timings['region'] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    app.save_prediction([enh_img, roi_img], ['Input Image', classified_f_label[0]], render_path)
+    timings['render'] = time.perf_counter() - start
+
+    return timings
+
+def time_submit(client, data, name):
+    start = time.perf_counter()
+    response = client.post('/submit', data={'image': (io.BytesIO(data), name)})
+    elapsed = time.perf_counter() - start
+    if response.status_code != 200:
+        raise RuntimeError('/submit answered %d for %s' % (response.status_code, name))
+
+    return elapsed
+
+# ====================================================================================================
+# Memory newly allocated during one /submit, traced by tracemalloc (NumPy arrays, including the ones
+# OpenCV returns), with and without the buffer pool. Each traced request follows an untraced one, so
+# the pool already holds the buffers that fit under app.BUFFER_POOL_MAX_BYTES. o/p: peak and retained
+# MB per mode, MB served from the pool
+# ----------------------------------------------------------------------------------------------------
+def trace_submit(client, data, name):
+    saved_pool = app.BUFFER_POOL
+    memory = {}
+    try:
+        for mode, pooled in (('no_pool', False), ('pool', True)):
+            app.BUFFER_POOL = pooled
+            time_submit(client, data, name)
+            reused = app.buffer_pool_stats()['reused_bytes']
+            tracemalloc.start()
+            try:
+                time_submit(client, data, name)
+                current, peak = tracemalloc.get_traced_memory()
+            finally:
+                tracemalloc.stop()
+            memory[mode] = {'peak_mb': round(peak / 1048576.0, 1), 'retained_mb': round(current / 1048576.0, 1)}
+            if pooled:
+                memory['pool_reused_mb'] = round((app.buffer_pool_stats()['reused_bytes'] - reused) / 1048576.0, 1)
+    finally:
+        app.BUFFER_POOL = saved_pool
+
+    return memory
+
+def run_case(name, data, seg_mode, repeat, client, tmp_dir, trace_memory=False):
+    inp_img = app.decode_image(data)
+    megapixels = inp_img.shape[0] * inp_img.shape[1] / 1e6
+    del inp_img
+
+    reset_peak_rss()
+    stage_runs = [time_stages(data, seg_mode, os.path.join(tmp_dir, 'render.png')) for idx in range(repeat)]
+    submit_runs = [time_submit(client, data, 'bench_%d.jpg' % idx) for idx in range(repeat)]
+    submit = float(np.median(submit_runs))
+
+    result = {
+        'megapixels': round(megapixels, 3),
+        'stages': {stage: float(np.median([run[stage] for run in stage_runs])) for stage in STAGES},
+        'pipeline': float(np.median([sum(run.values()) for run in stage_runs])),
+        'submit': submit,
+        'submit_min': float(min(submit_runs)),
+        'throughput_images_per_s': 1.0 / submit,
+        'throughput_megapixels_per_s': megapixels / submit,
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+    }
+    if trace_memory:
+        result['traced_memory'] = trace_submit(client, data, 'bench_trace.jpg')
+
+    return result
+
+# ====================================================================================================
+# Cold start: import app in fresh interpreters and collect the wall time until the import returns
+# (the app is ready) together with the app's own startup report
+# ----------------------------------------------------------------------------------------------------
+def measure_startup(runs):
+    code = 'import json, app; print(json.dumps(app.startup_report()))'
+    reports = []
+    for idx in range(runs):
+        start = time.perf_counter()
+        output = subprocess.run([sys.executable, '-W', 'ignore', '-c', code], check=True, capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout
+        report = json.loads(output.strip().splitlines()[-1])
+        report['wall'] = time.perf_counter() - start
+        reports.append(report)
+
+    return {key: float(np.median([report[key] for report in reports])) for key in ('wall', 'imports', 'models', 'warmup', 'total')
+            if all(report.get(key) is not None for report in reports)}
+
+# ====================================================================================================
+# Compare against a baseline: o/p list of (case, metric, baseline, current, ratio) over the threshold.
+# Timings below min_seconds in both runs are ignored as noise.
+# ----------------------------------------------------------------------------------------------------
+def compare(current, baseline, threshold, min_seconds=0.01):
+    regressions = []
+    for case, result in current['cases'].items():
+        base = baseline['cases'].get(case)
+        if base is None:
+            continue
+        metrics = [('submit', base['submit'], result['submit']), ('pipeline', base['pipeline'], result['pipeline'])]
+        metrics += [('stage:' + stage, base['stages'].get(stage, 0.0), result['stages'][stage]) for stage in STAGES]
+        regressions += _over_threshold(case, metrics, threshold, min_seconds)
+    if 'startup' in current and 'startup' in baseline:
+        metrics = [(key, baseline['startup'][key], value) for key, value in current['startup'].items() if key in baseline['startup']]
+        regressions += _over_threshold('startup', metrics, threshold, min_seconds)
+
+    return regressions
+
+def _over_threshold(case, metrics, threshold, min_seconds):
+    regressions = []
+    for metric, base_value, value in metrics:
+        if max(base_value, value) < min_seconds or base_value <= 0:
+            continue
+        if value > base_value * (1 + threshold):
+            regressions.append((case, metric, base_value, value, value / base_value))
+
+    return regressions
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmark the plant disease detection pipeline.')
+    parser.add_argument('--images', nargs='*', default=BUNDLED_IMAGES, help='bundled images, directories or globs (default: inp.jpg UPLOAD_FOLDER)')
+    parser.add_argument('--no-bundled', action='store_true', help='skip the bundled images')
+    parser.add_argument('--sizes', nargs='*', type=float, default=SYNTHETIC_SIZES, help='synthetic image sizes in megapixels (default: 0.3 1 2 6 12 24)')
+    parser.add_argument('--segmentation', choices=['full', 'fast'], help='segmentation mode (default: SEGMENTATION_MODE)')
+    parser.add_argument('--repeat', type=int, default=3, help='runs per case, the median is reported (default: 3)')
+    parser.add_argument('-o', '--output', default='benchmark_results.json', help='result JSON (default: benchmark_results.json)')
+    parser.add_argument('--baseline', help='baseline JSON to compare against')
+    parser.add_argument('--threshold', type=float, default=0.2, help='allowed slowdown against the baseline (default: 0.2 = 20%%)')
+    parser.add_argument('--save-baseline', metavar='PATH', help='also store the results as a new baseline')
+    parser.add_argument('--startup', type=int, default=0, metavar='RUNS', help='also measure cold start over RUNS fresh interpreters')
+    parser.add_argument('--trace-memory', action='store_true', help='also trace the memory allocated by /submit with and without the buffer pool')
+    args = parser.parse_args(argv)
+
+    seg_mode = args.segmentation or app.SEGMENTATION_MODE
+    app.SEGMENTATION_MODE = seg_mode
+    # Every /submit must run the pipeline: no result cache, no upload persistence
+    app.RESULT_CACHE_SIZE = 0
+    app.PERSIST_UPLOADS = False
+    app.load_models()
+
+    cases = []
+    if not args.no_bundled:
+        for path in list_images(args.images):
+            with open(path, 'rb') as img_file:
+                cases.append((path, img_file.read()))
+    for megapixels in args.sizes:
+        cases.append(('synthetic_%gmp' % megapixels, synthetic_leaf(megapixels)))
+
+    client = app.app.test_client()
+    results = {
+        'meta': {
+            'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': platform.python_version(),
+            'numpy': np.__version__,
+            'opencv': cv.__version__,
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'segmentation': seg_mode,
+            'render_backend': app.RENDER_BACKEND,
+            'repeat': args.repeat,
+            'model_version': app.model_version(),
+        },
+        'cases': {},
+    }
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        saved_pred_folder = app.PRED_FOLDER
+        app.PRED_FOLDER = tmp_dir + os.sep
+        try:
+            for name, data in cases:
+                result = run_case(name, data, seg_mode, args.repeat, client, tmp_dir, args.trace_memory)
+                results['cases'][name] = result
+                print('%-50s %7.2f MP  submit %8.3f s  pipeline %8.3f s  %6.2f img/s  peak RSS %7.1f MB' % (
+                      name[-50:], result['megapixels'], result['submit'], result['pipeline'],
+                      result['throughput_images_per_s'], result['peak_rss_mb']), file=sys.stderr)
+                if args.trace_memory:
+                    memory = result['traced_memory']
+                    print('%-50s allocated per /submit: peak %7.1f MB without pool, %7.1f MB with pool (%7.1f MB reused)' % (
+                          '', memory['no_pool']['peak_mb'], memory['pool']['peak_mb'], memory['pool_reused_mb']), file=sys.stderr)
+        finally:
+            app.PRED_FOLDER = saved_pred_folder
+
+    if args.startup > 0:
+        results['startup'] = measure_startup(args.startup)
+        print('startup: %s' % ', '.join('%s %.3f s' % item for item in results['startup'].items()), file=sys.stderr)
+
+    with open(args.output, 'w') as out_file:
+        json.dump(results, out_file, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as out_file:
+            json.dump(results, out_file, indent=2)
+
+    if not args.baseline:
+        return 0
+
+    with open(args.baseline) as base_file:
+        baseline = json.load(base_file)
+    if baseline['meta'].get('segmentation') != seg_mode:
+        print('Warning: baseline used segmentation %s, this run %s' % (baseline['meta'].get('segmentation'), seg_mode), file=sys.stderr)
+    regressions = compare(results, baseline, args.threshold)
+    for case, metric, base_value, value, ratio in regressions:
+        print('REGRESSION %s %s: %.3f s -> %.3f s (%.0f%% slower)' % (case, metric, base_value, value, 100 * (ratio - 1)), file=sys.stderr)
+    print('%d regression(s) over %.0f%% against %s' % (len(regressions), 100 * args.threshold, args.baseline), file=sys.stderr)
+
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
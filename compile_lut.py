@@ -0,0 +1,151 @@
+# HSV Lookup Table Compiler
+# Evaluates every tier's classifier once over the whole 256^3 HSV grid and writes the predictions as
+# packed bit tables (LUT_FOLDER/<tier>.npy, 2 MiB each) plus a manifest with the hash of the model
+# file each table was compiled from. The begin tier's feature_1 > 70 rule is folded into its table
+# (app.LUT_FOLDED). Tiers sharing a model file are evaluated once. Serve the tables with
+# CLASSIFIER_BACKEND=lut.
+# --verify checks the written tables against svclassifier.predict (every grid point, or --samples
+# random points) and compares the prediction cascade of both backends on random feature sets.
+#
+# Usage:
+#   python compile_lut.py
+#   python compile_lut.py --verify
+#   python compile_lut.py --verify-only --samples 1000000
+# ================================================================================================
+import argparse
+import json
+import os
+import sys
+import time
+
+import numpy as np
+
+import app
+
+GRID_SIZE = 1 << 24
+
+# ====================================================================================================
+# HSV triples of the grid indices [start, stop): h << 16 | s << 8 | v
+# ----------------------------------------------------------------------------------------------------
+def grid_features(idx):
+    return np.stack((idx >> 16, (idx >> 8) & 255, idx & 255), axis=1)
+
+# ====================================================================================================
+# Whether the classifier predicts label 1 for every grid point, o/p: bool (2^24)
+# ----------------------------------------------------------------------------------------------------
+def evaluate_grid(model, chunk_size=1 << 20):
+    bits = np.empty(GRID_SIZE, dtype=bool)
+    for start in range(0, GRID_SIZE, chunk_size):
+        idx = np.arange(start, min(start + chunk_size, GRID_SIZE))
+        bits[idx] = np.asarray(model.predict(grid_features(idx))) == 1
+
+    return bits
+
+# Clear the grid points whose feature column is not above the folded lower bound
+def fold_rule(bits, fold):
+    column, bound = fold
+    cube = bits.reshape(256, 256, 256)
+    region = [slice(None)] * 3
+    region[column] = slice(0, bound + 1)
+    cube[tuple(region)] = False
+
+    return bits
+
+def compile_tables(out_dir):
+    os.makedirs(out_dir, exist_ok=True)
+    manifest = {'index': 'h << 16 | s << 8 | v', 'bitorder': 'big', 'tiers': {}}
+    evaluated = {}
+    for tier, filename in app.TIER_MODELS.items():
+        start = time.perf_counter()
+        file_hash = app._file_hash(filename)
+        if file_hash not in evaluated:
+            evaluated[file_hash] = evaluate_grid(app.get_model(tier))
+        bits = evaluated[file_hash].copy()
+        if tier in app.LUT_FOLDED:
+            fold_rule(bits, app.LUT_FOLDED[tier])
+        np.save(os.path.join(out_dir, tier + '.npy'), np.packbits(bits))
+        manifest['tiers'][tier] = {
+            'table': tier + '.npy',
+            'model': filename,
+            'hash': file_hash,
+            'folded': app.LUT_FOLDED.get(tier),
+            'positives': int(np.count_nonzero(bits)),
+        }
+        print('%-13s %s -> %s (%d positive HSV values) in %.1f s' % (tier, filename, tier + '.npy', manifest['tiers'][tier]['positives'],
+              time.perf_counter() - start), file=sys.stderr)
+
+    # The manifest is written last and replaced atomically: a partial compile is never picked up
+    manifest_path = os.path.join(out_dir, app.LUT_MANIFEST)
+    with open(manifest_path + '.tmp', 'w') as manifest_file:
+        json.dump(manifest, manifest_file, indent=2)
+    os.replace(manifest_path + '.tmp', manifest_path)
+
+# ====================================================================================================
+# Verification: table bits against svclassifier.predict (with the folded rule applied) on every grid
+# point or a random sample, then the label cascade of both backends on random feature sets
+# ----------------------------------------------------------------------------------------------------
+def verify_tables(out_dir, samples=None, cascade_images=2000, seed=0):
+    rng = np.random.default_rng(seed)
+    with open(os.path.join(out_dir, app.LUT_MANIFEST)) as manifest_file:
+        manifest = json.load(manifest_file)
+    mismatches = 0
+    tables = {}
+    for tier, info in manifest['tiers'].items():
+        table = np.load(os.path.join(out_dir, info['table']), mmap_mode='r')
+        tables[tier] = table
+        model = app.get_model(tier)
+        checked = tier_mismatch = 0
+        if samples:
+            chunks = [np.sort(rng.choice(GRID_SIZE, samples, replace=False))]
+        else:
+            chunks = (np.arange(start, start + (1 << 20)) for start in range(0, GRID_SIZE, 1 << 20))
+        for idx in chunks:
+            features = grid_features(idx)
+            expected = np.asarray(model.predict(features)) == 1
+            if info['folded']:
+                column, bound = info['folded']
+                expected &= features[:, column] > bound
+            tier_mismatch += int(np.count_nonzero(app.lut_predict(table, features) != expected))
+            checked += len(idx)
+        if info['hash'] != app._file_hash(info['model']):
+            print('%-13s table was compiled for another version of %s' % (tier, info['model']), file=sys.stderr)
+            tier_mismatch += 1
+        print('%-13s %d / %d grid points disagree' % (tier, tier_mismatch, checked), file=sys.stderr)
+        mismatches += tier_mismatch
+
+    # Random feature sets of 1-5 clusters, half of the features drawn from the table positives
+    positives = np.flatnonzero(np.unpackbits(tables['explored']))
+    t_features = []
+    for image in range(cascade_images):
+        idx = rng.integers(0, GRID_SIZE, size=int(rng.integers(1, app.NO_OF_CLUSTER + 1)))
+        if positives.size > 0:
+            pick = rng.random(idx.size) < 0.5
+            idx[pick] = rng.choice(positives, size=int(pick.sum()))
+        t_features.append(grid_features(idx).tolist())
+    labels = {}
+    for backend in ('svc', 'lut'):
+        app.CLASSIFIER_BACKEND = backend
+        labels[backend] = app.prediction_batch(t_features)
+    cascade_mismatch = sum(svc != lut for svc, lut in zip(zip(*labels['svc']), zip(*labels['lut'])))
+    print('cascade       %d / %d feature sets disagree' % (cascade_mismatch, cascade_images), file=sys.stderr)
+
+    return mismatches + cascade_mismatch
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compile the tier classifiers into packed HSV lookup tables.')
+    parser.add_argument('-o', '--output', default=app.LUT_FOLDER, help='table directory (default: LUT_FOLDER, i.e. %s)' % app.LUT_FOLDER)
+    parser.add_argument('--verify', action='store_true', help='verify the tables against the classifiers after compiling')
+    parser.add_argument('--verify-only', action='store_true', help='only verify existing tables')
+    parser.add_argument('--samples', type=int, help='verify this many random grid points instead of the whole grid')
+    args = parser.parse_args(argv)
+
+    app.LUT_FOLDER = args.output
+    if not args.verify_only:
+        compile_tables(args.output)
+    if args.verify or args.verify_only:
+        return 1 if verify_tables(args.output, args.samples) else 0
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
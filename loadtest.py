@@ -0,0 +1,158 @@
+# Load Test
+# Starts serve.py with each of the given worker counts, waits for /ready and sends the same number of
+# concurrent clients against /api/predict (raw JPEG body) or /submit (multipart upload) for a fixed
+# time. Synthetic leaf images (benchmark.synthetic_leaf, a few seeds) are uploaded and the server's
+# result cache is disabled, so every request runs the pipeline. For every worker count the
+# throughput, latency percentiles, errors and the speed-up over the first worker count are reported.
+# With --url an already running server is tested once instead.
+#
+# Usage:
+#   python loadtest.py --workers 1 2 4 --clients 8 --duration 20
+#   python loadtest.py --url http://127.0.0.1:5000 --endpoint /submit --clients 4
+# ================================================================================================
+import argparse
+import http.client
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+import urllib.parse
+import uuid
+
+import numpy as np
+
+from benchmark import synthetic_leaf
+
+# ====================================================================================================
+# Request body and headers of one upload
+# ----------------------------------------------------------------------------------------------------
+def build_request(endpoint, jpg, name):
+    if endpoint == '/api/predict':
+        return jpg, {'Content-Type': 'image/jpeg'}
+
+    boundary = uuid.uuid4().hex
+    body = (b'--' + boundary.encode() + b'\r\nContent-Disposition: form-data; name="image"; filename="' + name.encode() +
+            b'"\r\nContent-Type: image/jpeg\r\n\r\n' + jpg + b'\r\n--' + boundary.encode() + b'--\r\n')
+
+    return body, {'Content-Type': 'multipart/form-data; boundary=' + boundary}
+
+def wait_ready(url, timeout=120):
+    parts = urllib.parse.urlsplit(url)
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=5)
+            conn.request('GET', '/ready')
+            if conn.getresponse().status == 200:
+                return True
+        except OSError:
+            pass
+        time.sleep(0.5)
+
+    return False
+
+# ====================================================================================================
+# Concurrent clients, each on its own keep-alive connection, o/p: latencies (s) and error count
+# ----------------------------------------------------------------------------------------------------
+def run_load(url, endpoint, requests, clients, duration):
+    parts = urllib.parse.urlsplit(url)
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    deadline = time.monotonic() + duration
+
+    def client(idx):
+        conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=300)
+        count = idx
+        while time.monotonic() < deadline:
+            body, headers = requests[count % len(requests)]
+            count += 1
+            start = time.perf_counter()
+            try:
+                conn.request('POST', endpoint, body=body, headers=headers)
+                response = conn.getresponse()
+                response.read()
+                ok = response.status == 200
+            except (OSError, http.client.HTTPException):
+                conn.close()
+                conn = http.client.HTTPConnection(parts.hostname, parts.port, timeout=300)
+                ok = False
+            with lock:
+                if ok:
+                    latencies.append(time.perf_counter() - start)
+                else:
+                    errors[0] += 1
+        conn.close()
+
+    threads = [threading.Thread(target=client, args=(idx,)) for idx in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    return latencies, errors[0], time.perf_counter() - start
+
+def summarize(workers, latencies, errors, elapsed):
+    lat = np.array(latencies) if latencies else np.zeros(1)
+    return {
+        'workers': workers,
+        'requests': len(latencies),
+        'errors': errors,
+        'throughput': len(latencies) / elapsed,
+        'p50': float(np.percentile(lat, 50)),
+        'p95': float(np.percentile(lat, 95)),
+    }
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Measure request throughput of serve.py for several worker counts.')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 2, 4], help='worker counts to compare (default: 1 2 4)')
+    parser.add_argument('--threads', type=int, default=2, help='threads per worker (default: 2)')
+    parser.add_argument('--clients', type=int, default=8, help='concurrent clients (default: 8)')
+    parser.add_argument('--duration', type=float, default=20, help='seconds of load per worker count (default: 20)')
+    parser.add_argument('--endpoint', choices=['/api/predict', '/submit'], default='/api/predict', help='endpoint under test (default: /api/predict)')
+    parser.add_argument('--megapixels', type=float, default=0.3, help='size of the synthetic upload images (default: 0.3)')
+    parser.add_argument('--segmentation', choices=['full', 'fast'], default='fast', help='SEGMENTATION_MODE of the server (default: fast)')
+    parser.add_argument('--cv-threads', type=int, default=1, help='OpenCV threads per worker (default: 1)')
+    parser.add_argument('--port', type=int, default=5055, help='port of the started servers (default: 5055)')
+    parser.add_argument('--url', help='test this running server instead of starting serve.py')
+    parser.add_argument('-o', '--output', help='also write the results as JSON')
+    args = parser.parse_args(argv)
+
+    requests = [build_request(args.endpoint, synthetic_leaf(args.megapixels, seed), 'leaf_%d.jpg' % seed) for seed in range(4)]
+    results = []
+    runs = [(None, args.url)] if args.url else [(workers, 'http://127.0.0.1:%d' % args.port) for workers in args.workers]
+    for workers, url in runs:
+        server = None
+        if workers is not None:
+            env = dict(os.environ, RESULT_CACHE_SIZE='0', SEGMENTATION_MODE=args.segmentation)
+            server = subprocess.Popen([sys.executable, 'serve.py', '--bind', '127.0.0.1:%d' % args.port, '--workers', str(workers),
+                                       '--threads', str(args.threads), '--cv-threads', str(args.cv_threads)], env=env)
+        try:
+            if not wait_ready(url):
+                print('server at %s did not become ready' % url, file=sys.stderr)
+                return 1
+            latencies, errors, elapsed = run_load(url, args.endpoint, requests, args.clients, args.duration)
+        finally:
+            if server is not None:
+                server.terminate()
+                server.wait()
+        results.append(summarize(workers, latencies, errors, elapsed))
+
+    base = results[0]['throughput'] or 1.0
+    print('%8s %9s %7s %12s %9s %9s %8s' % ('workers', 'requests', 'errors', 'requests/s', 'p50 s', 'p95 s', 'speed-up'))
+    for row in results:
+        row['speedup'] = row['throughput'] / base
+        print('%8s %9d %7d %12.2f %9.3f %9.3f %7.2fx' % (row['workers'] or '-', row['requests'], row['errors'], row['throughput'],
+              row['p50'], row['p95'], row['speedup']))
+    print('%d CPU(s); throughput can only scale up to the number of cores' % (os.cpu_count() or 1))
+    if args.output:
+        with open(args.output, 'w') as out_file:
+            json.dump({'cpus': os.cpu_count(), 'endpoint': args.endpoint, 'clients': args.clients, 'results': results}, out_file, indent=2)
+
+    return 1 if any(row['errors'] for row in results) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,68 @@
+# Pre-Screen Check
+# Runs every image through the full-resolution pipeline and through the thumbnail pre-screen cascade
+# (app.detect with prescreen=False / True, same K-Means seed) and reports per image both labels,
+# whether the cascade escalated to full resolution and the time of both runs; the summary gives the
+# escalation rate, the label agreement, the false negatives (disease at full resolution, returned as
+# negative by the pre-screen) and the overall speed-up. Exit code 1 when there are more false
+# negatives than --max-false-negatives.
+#
+# Usage:
+#   python prescreen_check.py
+#   python prescreen_check.py "UPLOAD_FOLDER/*" --margin 16 --side 320 --segmentation fast
+# ================================================================================================
+import argparse
+import sys
+import time
+
+import cv2 as cv
+
+import app
+from batch_score import list_images
+
+def check_image(path, seed, seg_mode=None):
+    inp_img = app.read_image(path)
+    outcome = {'path': path}
+    for name, prescreen in (('full', False), ('cascade', True)):
+        cv.setRNGSeed(seed)
+        start = time.perf_counter()
+        result = app.detect(inp_img, seg_mode=seg_mode, prescreen=prescreen, render=False)
+        outcome['t_' + name] = time.perf_counter() - start
+        outcome['label_' + name] = result['label']
+        if prescreen:
+            outcome['escalated'] = result['prescreen']['escalated']
+    outcome['same_label'] = outcome['label_full'] == outcome['label_cascade']
+    outcome['false_negative'] = outcome['label_full'] not in app.NEGATIVE_LABELS and not outcome['escalated']
+
+    return outcome
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare the thumbnail pre-screen cascade with the full-resolution pipeline.')
+    parser.add_argument('inputs', nargs='*', default=['inp.jpg', 'UPLOAD_FOLDER'], help='image files, directories or glob patterns')
+    parser.add_argument('--margin', type=int, default=app.PRESCREEN_MARGIN, help='HSV confidence margin (default: PRESCREEN_MARGIN, i.e. %d)' % app.PRESCREEN_MARGIN)
+    parser.add_argument('--side', type=int, default=app.PRESCREEN_SIDE, help='thumbnail longest side (default: PRESCREEN_SIDE, i.e. %d)' % app.PRESCREEN_SIDE)
+    parser.add_argument('--segmentation', choices=['full', 'fast'], help='segmentation mode (default: SEGMENTATION_MODE, i.e. full)')
+    parser.add_argument('--seed', type=int, default=0, help='K-Means seed of both runs (default: 0)')
+    parser.add_argument('--max-false-negatives', type=int, default=0, help='allowed false negatives (default: 0)')
+    args = parser.parse_args(argv)
+
+    app.PRESCREEN_MARGIN = args.margin
+    app.PRESCREEN_SIDE = args.side
+    outcomes = [check_image(path, args.seed, args.segmentation) for path in list_images(args.inputs)]
+
+    print('%-45s %9s %9s %9s  %s' % ('image', 'escalated', 'full s', 'cascade s', 'label (full / cascade)'))
+    for outcome in outcomes:
+        print('%-45s %9s %9.2f %9.2f  %s / %s%s' % (outcome['path'][-45:], 'yes' if outcome['escalated'] else 'no', outcome['t_full'], outcome['t_cascade'],
+              outcome['label_full'].replace('Classified Label: ', ''), outcome['label_cascade'].replace('Classified Label: ', ''),
+              '  FALSE NEGATIVE' if outcome['false_negative'] else ''))
+
+    false_negatives = sum(outcome['false_negative'] for outcome in outcomes)
+    if outcomes:
+        print('%d image(s), margin %d, side %d: escalation rate %.1f%%, label agreement %.1f%%, %d false negative(s), speed-up %.2fx' % (
+              len(outcomes), args.margin, args.side, 100.0 * sum(outcome['escalated'] for outcome in outcomes) / len(outcomes),
+              100.0 * sum(outcome['same_label'] for outcome in outcomes) / len(outcomes), false_negatives,
+              sum(outcome['t_full'] for outcome in outcomes) / sum(outcome['t_cascade'] for outcome in outcomes)))
+
+    return 1 if false_negatives > args.max_false_negatives else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
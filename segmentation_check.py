@@ -0,0 +1,88 @@
+# Segmentation Quality Check
+# Compares the fast segmentation mode against the full K-Means segmentation on a set of images.
+# For every image both modes are run with the same seed, the fast clusters are matched to the full
+# clusters (best of all label permutations) and the share of pixels with the same cluster is reported
+# together with the classified label of both modes and the time each mode took.
+# K-Means is itself sensitive to its initialization; with --baseline the full mode is run a second
+# time with another seed and the fast mode only has to agree within --tolerance of that baseline.
+#
+# Usage:
+#   python segmentation_check.py inp.jpg "UPLOAD_FOLDER/*" --min-agreement 0.9
+#   python segmentation_check.py "UPLOAD_FOLDER/*.png" --baseline
+# ================================================================================================
+import argparse
+import itertools
+import sys
+import time
+
+import numpy as np
+import cv2 as cv
+
+import app
+from batch_score import list_images
+
+# ====================================================================================================
+# Share of pixels whose labels agree under the best one-to-one mapping of fast onto full clusters
+# ----------------------------------------------------------------------------------------------------
+def label_agreement(full_lbl, fast_lbl):
+    k = app.NO_OF_CLUSTER
+    confusion = np.bincount(full_lbl.ravel() * k + fast_lbl.ravel(), minlength=k * k).reshape(k, k)
+    best = max(sum(confusion[perm[idx], idx] for idx in range(k)) for perm in itertools.permutations(range(k)))
+
+    return best / full_lbl.size
+
+def check_image(path, seed, baseline=False):
+    inp_img = cv.imread(path)
+    inp_img_cmap = cv.cvtColor(inp_img, cv.COLOR_BGR2RGB)
+    hsv_cmap = cv.cvtColor(inp_img_cmap, cv.COLOR_BGR2HSV)
+
+    outcome = {'path': path, 'megapixels': hsv_cmap.shape[0] * hsv_cmap.shape[1] / 1e6}
+    labels = {}
+    for mode in ('full', 'fast'):
+        start = time.perf_counter()
+        seg_img, seg_lbl = app.segmentation_process(hsv_cmap, mode=mode, seed=seed)
+        outcome['t_' + mode] = time.perf_counter() - start
+        feature_set, feature_df = app.get_features([seg_img], [seg_lbl], as_frame=False)
+        classified_f, classified_f_label = app.prediction(feature_set, feature_df)
+        outcome['label_' + mode] = classified_f_label[0]
+        labels[mode] = seg_lbl
+
+    outcome['agreement'] = label_agreement(labels['full'], labels['fast'])
+    if baseline:
+        seg_img, seg_lbl = app.segmentation_process(hsv_cmap, mode='full', seed=seed + 1)
+        outcome['baseline'] = label_agreement(labels['full'], seg_lbl)
+    outcome['same_label'] = outcome['label_full'] == outcome['label_fast']
+
+    return outcome
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Compare fast and full segmentation on sample images.')
+    parser.add_argument('inputs', nargs='*', default=['inp.jpg', 'UPLOAD_FOLDER'], help='image files, directories or glob patterns')
+    parser.add_argument('--seed', type=int, default=0, help='K-Means seed used by both modes (default: 0)')
+    parser.add_argument('--min-agreement', type=float, default=0.85, help='minimum pixel label agreement (default: 0.85)')
+    parser.add_argument('--baseline', action='store_true', help='also measure full-vs-full agreement with a second seed')
+    parser.add_argument('--tolerance', type=float, default=0.05, help='allowed agreement shortfall against the baseline (default: 0.05)')
+    args = parser.parse_args(argv)
+
+    outcomes = [check_image(path, args.seed, args.baseline) for path in list_images(args.inputs)]
+
+    print('%-50s %7s %9s %9s %8s %8s  %s' % ('image', 'MP', 'agreement', 'baseline', 'full s', 'fast s', 'label (full / fast)'))
+    for outcome in outcomes:
+        baseline = '%8.2f%%' % (100 * outcome['baseline']) if 'baseline' in outcome else '%9s' % '-'
+        print('%-50s %7.2f %8.2f%% %s %8.2f %8.2f  %s / %s' % (outcome['path'][-50:], outcome['megapixels'], 100 * outcome['agreement'], baseline,
+              outcome['t_full'], outcome['t_fast'], outcome['label_full'].replace('Classified Label: ', ''), outcome['label_fast'].replace('Classified Label: ', '')))
+
+    failed = []
+    for outcome in outcomes:
+        min_agreement = outcome['baseline'] - args.tolerance if 'baseline' in outcome else args.min_agreement
+        if outcome['agreement'] < min_agreement or not outcome['same_label']:
+            failed.append(outcome)
+    if outcomes:
+        print('%d image(s), mean agreement %.2f%%, %d failed (different label or low agreement), speed-up %.1fx' % (
+              len(outcomes), 100 * np.mean([outcome['agreement'] for outcome in outcomes]), len(failed),
+              sum(outcome['t_full'] for outcome in outcomes) / sum(outcome['t_fast'] for outcome in outcomes)))
+
+    return 1 if failed else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
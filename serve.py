@@ -0,0 +1,78 @@
+# Production Server
+# Serves the Flask app with gunicorn: pre-forked worker processes (--workers), each answering
+# requests on a pool of threads (--threads). The app is imported once in the master process before
+# the workers are forked (preload_app), so the models are loaded and warmed up once and their memory
+# is shared copy-on-write by every worker. The warm-up therefore always runs synchronously here.
+# Each worker runs at most --max-concurrent pipeline requests at once (MAX_CONCURRENT); with several
+# workers --cv-threads 1 stops OpenCV from starting a thread per core in every worker.
+# Metrics and the result cache are kept per worker process: every /metrics sample carries a
+# worker_pid label, and a scrape reaches whichever worker accepts it. Async jobs (ASYNC_SUBMIT) run in
+# the worker that accepted them, and their status is shared with the other workers through JOB_FOLDER.
+# The app logs to stderr at LOG_LEVEL (default WARNING), each line tagged with its worker's pid.
+#
+# Usage:
+#   python serve.py --workers 4 --threads 4 --bind 0.0.0.0:5000
+#   python serve.py --workers 2 --max-concurrent 2 --cv-threads 1
+# ================================================================================================
+import argparse
+import logging
+import os
+import sys
+
+from gunicorn.app.base import BaseApplication
+
+class PreloadedApplication(BaseApplication):
+    def __init__(self, options):
+        self.options = options
+        super().__init__()
+
+    def load_config(self):
+        for key, value in self.options.items():
+            self.cfg.set(key, value)
+
+    def load(self):
+        # gunicorn only configures its own loggers: log the app at LOG_LEVEL (inherited by the workers),
+        # set up before the import so the model load and warm-up messages are included
+        logging.basicConfig(level=os.environ.get('LOG_LEVEL', 'WARNING').upper(),
+                            format='%(asctime)s [%(process)d] %(levelname)s %(name)s: %(message)s')
+        import app
+        return app.app
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Serve the Yellow-Rust detector with pre-forked gunicorn workers.')
+    parser.add_argument('-b', '--bind', default=os.environ.get('BIND', '127.0.0.1:5000'), help='address to listen on (default: BIND or 127.0.0.1:5000)')
+    parser.add_argument('-w', '--workers', type=int, default=int(os.environ.get('WEB_WORKERS', os.cpu_count() or 1)), help='worker processes (default: WEB_WORKERS or CPU count)')
+    parser.add_argument('-t', '--threads', type=int, default=int(os.environ.get('WEB_THREADS', 4)), help='request threads per worker (default: WEB_THREADS or 4)')
+    parser.add_argument('--max-concurrent', type=int, help='pipeline requests running at once per worker (default: MAX_CONCURRENT, 0 = no limit)')
+    parser.add_argument('--cv-threads', type=int, help='OpenCV threads per worker (default: OpenCV decides)')
+    parser.add_argument('--timeout', type=int, default=120, help='seconds before a silent worker is restarted (default: 120)')
+    parser.add_argument('--access-log', action='store_true', help='log every request to stderr')
+    args = parser.parse_args(argv)
+
+    # Settings read by app at import time; a warm-up thread would not survive the fork
+    if os.environ.get('STARTUP_WARMUP', 'sync') != 'off':
+        os.environ['STARTUP_WARMUP'] = 'sync'
+    if args.max_concurrent is not None:
+        os.environ['MAX_CONCURRENT'] = str(args.max_concurrent)
+
+    def post_fork(server, worker):
+        if args.cv_threads is not None:
+            import cv2
+            cv2.setNumThreads(args.cv_threads)
+
+    options = {
+        'bind': args.bind,
+        'workers': args.workers,
+        'threads': args.threads,
+        'worker_class': 'gthread',
+        'preload_app': True,
+        'timeout': args.timeout,
+        'post_fork': post_fork,
+        'accesslog': '-' if args.access_log else None,
+    }
+    PreloadedApplication(options).run()
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
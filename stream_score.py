@@ -0,0 +1,64 @@
+# Stream Scoring
+# Classifies the frames of a video file or camera device (app.stream_frames) and writes one JSON
+# object per processed frame (NDJSON) to stdout or a file as soon as the frame is done. The K-Means
+# clustering of each frame is warm-started from the previous frame; with --fps frames are skipped
+# to keep up with the target rate. The throughput (processed / skipped frames, frames per second,
+# mean latency) is reported on stderr.
+#
+# Usage:
+#   python stream_score.py field_run.mp4 --fps 5 -o field_run.ndjson
+#   python stream_score.py 0 --fps 2 --max-side 640 --segmentation fast
+# ================================================================================================
+import argparse
+import json
+import logging
+import sys
+import time
+
+import app
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Classify the frames of a video file or camera for Yellow-Rust disease.')
+    parser.add_argument('source', help='video file, stream URL or camera device index (e.g. 0)')
+    parser.add_argument('-o', '--output', help='NDJSON output file (default: stdout)')
+    parser.add_argument('--fps', type=float, help='target frames per second to process; other frames are skipped')
+    parser.add_argument('--max-frames', type=int, help='stop after this many processed frames')
+    parser.add_argument('--max-side', type=int, help='downscale frames to this longest side in pixels (default: STREAM_MAX_SIDE, 0 = off)')
+    parser.add_argument('--segmentation', choices=['full', 'fast'], help='segmentation mode (default: SEGMENTATION_MODE, i.e. full)')
+    parser.add_argument('--reseed-every', type=int, help='cold-start the clustering every N processed frames (default: STREAM_RESEED_EVERY, 0 = never)')
+    parser.add_argument('--realtime', action=argparse.BooleanOptionalAction,
+                        help='drop frames that fall behind the wall clock (default: on for a camera, off for a file); '
+                             '--no-realtime processes every frame of a camera too')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=app.LOG_LEVEL, format=app.LOG_FORMAT)
+
+    source = int(args.source) if args.source.isdigit() else args.source
+    out_file = open(args.output, 'w') if args.output else sys.stdout
+    record = None
+    latency = 0.0
+    start = time.perf_counter()
+    try:
+        frames = app.stream_frames(source, target_fps=args.fps, seg_mode=args.segmentation, max_frames=args.max_frames,
+                                   max_side=args.max_side, reseed_every=args.reseed_every, realtime=args.realtime)
+        for record in frames:
+            latency += record['latency']
+            out_file.write(json.dumps(record) + '\n')
+            out_file.flush()
+    except KeyboardInterrupt:
+        pass
+    except ValueError as err:
+        print(err, file=sys.stderr)
+        return 1
+    finally:
+        if out_file is not sys.stdout:
+            out_file.close()
+
+    elapsed = time.perf_counter() - start
+    if record is not None:
+        print('%d frame(s) processed, %d skipped in %.1f s: %.2f frames/s, mean latency %.3f s' % (record['processed'], record['skipped'],
+              elapsed, record['processed'] / elapsed, latency / record['processed']), file=sys.stderr)
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,78 @@
+# Tiled Scoring
+# Runs the memory-bounded tiled pipeline (app.process_tiled) on large drone images or orthomosaics.
+# The cluster centers are fitted once on a sample of the whole image and the image is streamed tile
+# by tile; the label, mask and ROI rasters are written as memory-mapped .npy files into the output
+# directory together with the per-tile disease map (disease_map.npy, disease_map.png) and a JSON
+# summary with the overall label.
+# Memory stays bounded by the tile size only for .npy inputs (memory mapped); JPEG, PNG and TIFF files
+# are decoded whole by OpenCV before tiling, so a 100 MP image still needs ~300 MB for the decoded
+# pixels. Convert very large mosaics to a .npy raster first.
+#
+# Usage:
+#   python tile_score.py mosaic.tif -o mosaic_tiles --tile 1024
+#   python tile_score.py mosaic.npy -o mosaic_tiles --seed 0 --preview 2000
+# ================================================================================================
+import argparse
+import json
+import logging
+import os
+import sys
+
+import numpy as np
+import cv2 as cv
+
+import app
+
+# BGR colour of every disease map code (No Disease, Healthy, Begin, Mid-Explored, Explored)
+TILE_COLORS = np.array([[64, 64, 64], [60, 160, 60], [80, 220, 240], [40, 140, 250], [40, 40, 220]], dtype=np.uint8)
+
+# ====================================================================================================
+# Disease map image: one colour block per tile at the given pixel size
+# ----------------------------------------------------------------------------------------------------
+def render_disease_map(disease_map, block=16):
+    img = TILE_COLORS[disease_map]
+
+    return cv.resize(img, (disease_map.shape[1] * block, disease_map.shape[0] * block), interpolation=cv.INTER_NEAREST)
+
+# ====================================================================================================
+# Downscaled ROI preview read from the memory-mapped raster, at most max_side pixels along each side
+# ----------------------------------------------------------------------------------------------------
+def render_preview(roi_path, max_side):
+    roi = np.load(roi_path, mmap_mode='r')
+    step = max(1, -(-max(roi.shape[:2]) // max_side))
+
+    return np.ascontiguousarray(roi[::step, ::step])
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Score a large leaf, drone or orthomosaic image tile by tile.')
+    parser.add_argument('image', help='.npy raster (H x W x 3, BGR uint8), memory mapped; other image files are decoded whole into memory')
+    parser.add_argument('-o', '--output', help='output directory (default: <image name>_tiles)')
+    parser.add_argument('--tile', type=int, default=app.TILE_SIZE, help='tile size in pixels (default: TILE_SIZE, i.e. %d)' % app.TILE_SIZE)
+    parser.add_argument('--sample-size', type=int, default=app.FAST_SAMPLE_SIZE, help='pixels sampled to fit the cluster centers (default: %d)' % app.FAST_SAMPLE_SIZE)
+    parser.add_argument('--seed', type=int, help='seed of the pixel sample and the K-Means initialization')
+    parser.add_argument('--preview', type=int, metavar='PIXELS', help='also write roi_preview.png downscaled to at most PIXELS per side')
+    args = parser.parse_args(argv)
+    logging.basicConfig(level=app.LOG_LEVEL, format=app.LOG_FORMAT)
+
+    out_dir = args.output or os.path.splitext(args.image)[0] + '_tiles'
+    result = app.process_tiled(args.image, out_dir, tile_size=args.tile, seed=args.seed, sample_size=args.sample_size)
+
+    cv.imwrite(os.path.join(out_dir, 'disease_map.png'), render_disease_map(result['disease_map']))
+    if args.preview:
+        cv.imwrite(os.path.join(out_dir, 'roi_preview.png'), render_preview(result['paths']['roi'], args.preview))
+
+    summary = {key: result[key] for key in ('label', 'feature', 'height', 'width', 'area', 'tile_size', 'tile_labels', 'paths', 'timings')}
+    summary['image'] = args.image
+    summary['grid'] = list(result['disease_map'].shape)
+    with open(os.path.join(out_dir, 'summary.json'), 'w') as out_file:
+        json.dump(summary, out_file, indent=2)
+
+    print('%s: %s (%d x %d px, %d x %d tiles, %.2f%% diseased) in %.1f s' % (args.image, result['label'], result['width'], result['height'],
+          summary['grid'][1], summary['grid'][0], 100 * result['area']['fraction'], result['timings']['total']))
+    for label, count in result['tile_labels'].items():
+        print('  %-55s %d tile(s)' % (label, count))
+
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
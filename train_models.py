@@ -0,0 +1,226 @@
+# Model Training
+# Fits one RBF Support Vector Classifier per tier (explored, mid_explored, begin) on the tier's
+# feature table in app.py (FEATURE_SET_EXPLORED, FEATURE_SET_MID_EXPL, FEATURE_SET_BEGIN) or on an
+# external CSV of labelled features, and saves each model as a native model directory
+# (MODEL_FOLDER/<tier>, NumPy arrays loaded by memory mapping, see app.NativeSVC). With
+# --from-pickle the parameters of the pickled MODEL_FILENAME are exported for every tier instead,
+# which keeps the current predictions without unpickling at runtime.
+# A report (MODEL_FOLDER/report.json) records per tier the training and cross-validated accuracy,
+# the fit time, the load time (from file in a fresh interpreter, the pickle including its sklearn
+# import) and prediction time of the pickled and the native model, and the agreement of the native
+# decision function with sklearn on the HSV grid.
+# The server picks up new tier directories on restart; replaced models are hot-reloaded.
+#
+# CSV columns: feature_1, feature_2, feature_3, label (1 = Disease, 0 = Non-Disease) and an optional
+# tier column (explored, mid_explored, begin) selecting the rows of each tier.
+#
+# Usage:
+#   python train_models.py
+#   python train_models.py --csv labelled_features.csv --tiers explored begin
+#   python train_models.py --from-pickle --samples 0
+# ================================================================================================
+import argparse
+import csv
+import json
+import os
+import pickle
+import subprocess
+import sys
+import tempfile
+import time
+
+import numpy as np
+
+import app
+
+TIER_TABLES = {
+    'explored': 'FEATURE_SET_EXPLORED',
+    'mid_explored': 'FEATURE_SET_MID_EXPL',
+    'begin': 'FEATURE_SET_BEGIN',
+}
+
+# ====================================================================================================
+# Training rows of a tier: (N x 3) features and (N) labels
+# ----------------------------------------------------------------------------------------------------
+def read_csv_rows(path, tier):
+    rows = []
+    with open(path, newline='') as csv_file:
+        for row in csv.DictReader(csv_file):
+            if row.get('tier') and row['tier'] != tier:
+                continue
+            rows.append([int(row['feature_1']), int(row['feature_2']), int(row['feature_3']), int(row['label'])])
+
+    return rows
+
+def training_set(tier, csv_path=None):
+    rows = read_csv_rows(csv_path, tier) if csv_path else getattr(app, TIER_TABLES[tier])
+    table = np.array(rows, dtype=np.int64).reshape(-1, 4)
+
+    return table[:, :3], table[:, 3]
+
+# ====================================================================================================
+# Cross-validated accuracy (stratified folds), None when a class has fewer than two samples
+# ----------------------------------------------------------------------------------------------------
+def cv_accuracy(X, y, folds, C, gamma):
+    from sklearn.model_selection import StratifiedKFold
+    from sklearn.svm import SVC
+
+    folds = min(folds, int(np.bincount(y).min()) if len(np.unique(y)) > 1 else 0)
+    if folds < 2:
+        return None
+    scores = []
+    for train_idx, test_idx in StratifiedKFold(n_splits=folds, shuffle=True, random_state=0).split(X, y):
+        model = SVC(kernel='rbf', C=C, gamma=gamma).fit(X[train_idx], y[train_idx])
+        scores.append(float((model.predict(X[test_idx]) == y[test_idx]).mean()))
+
+    return float(np.mean(scores))
+
+# ====================================================================================================
+# Load time of a model in fresh interpreters (median of runs): app is imported first (numpy, no
+# sklearn, no warm-up), then only the load statement is timed, so the pickle's time includes the
+# sklearn import it triggers, as in a starting server
+# ----------------------------------------------------------------------------------------------------
+LOAD_CODE = {
+    'pickle': 'import pickle\nwith open(path, "rb") as model_file:\n    pickle.load(model_file)',
+    'native': 'app.NativeSVC.load(path)',
+}
+
+def measure_load(kind, path, runs=3):
+    code = ('import sys, time, app\npath = sys.argv[1]\nstart = time.perf_counter()\n' + LOAD_CODE[kind] +
+            '\nprint(time.perf_counter() - start)')
+    env = dict(os.environ, STARTUP_WARMUP='off')
+    times = []
+    for idx in range(runs):
+        output = subprocess.run([sys.executable, '-W', 'ignore', '-c', code, path], check=True, capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), env=env).stdout
+        times.append(float(output.strip().splitlines()[-1]))
+
+    return float(np.median(times))
+
+# ====================================================================================================
+# Native model against the sklearn model: load time (the model pickled to a file vs the native model
+# directory, both in fresh interpreters), prediction time and agreement on the HSV grid (every point
+# with samples=None, otherwise a random sample, skipped with samples=0)
+# ----------------------------------------------------------------------------------------------------
+def compare_models(model, model_dir, samples, seed=0):
+    with tempfile.TemporaryDirectory() as tmp_dir:
+        pickle_path = os.path.join(tmp_dir, 'model.sav')
+        with open(pickle_path, 'wb') as model_file:
+            pickle.dump(model, model_file)
+        pickle_load = measure_load('pickle', pickle_path)
+    native_load = measure_load('native', os.path.abspath(model_dir))
+    native = app.NativeSVC.load(model_dir)
+
+    rng = np.random.default_rng(seed)
+    timing_set = rng.integers(0, 256, size=(100000, 3))
+    start = time.perf_counter()
+    model.predict(timing_set)
+    sklearn_predict = time.perf_counter() - start
+    start = time.perf_counter()
+    native.predict(timing_set)
+    native_predict = time.perf_counter() - start
+
+    report = {
+        'load_seconds': {'pickle': pickle_load, 'native': native_load},
+        'predict_100k_seconds': {'sklearn': sklearn_predict, 'native': native_predict},
+    }
+    if samples == 0:
+        return report
+
+    if samples:
+        chunks = [rng.integers(0, 1 << 24, size=samples)]
+    else:
+        chunks = (np.arange(start, start + (1 << 20)) for start in range(0, 1 << 24, 1 << 20))
+    checked = mismatches = 0
+    max_diff = 0.0
+    for idx in chunks:
+        features = np.stack((idx >> 16, (idx >> 8) & 255, idx & 255), axis=1)
+        mismatches += int(np.count_nonzero(native.predict(features) != model.predict(features)))
+        max_diff = max(max_diff, float(np.abs(native.decision_function(features) - model.decision_function(features)).max()))
+        checked += len(idx)
+    report['grid_agreement'] = {'points': checked, 'mismatches': mismatches, 'max_decision_diff': max_diff}
+
+    return report
+
+def train_tier(tier, args):
+    from sklearn.svm import SVC
+
+    X, y = training_set(tier, args.csv)
+    start = time.perf_counter()
+    model = SVC(kernel='rbf', C=args.C, gamma=args.gamma).fit(X, y)
+    fit_time = time.perf_counter() - start
+
+    meta = {
+        'tier': tier,
+        'source': args.csv or 'app.' + TIER_TABLES[tier],
+        'samples': int(len(y)),
+        'positives': int(y.sum()),
+        'support_vectors': int(model.support_vectors_.shape[0]),
+        'C': args.C,
+        'gamma': float(model._gamma),
+        'train_accuracy': float((model.predict(X) == y).mean()),
+        'cv_accuracy': cv_accuracy(X, y, args.folds, args.C, args.gamma),
+        'fit_seconds': fit_time,
+        'trained_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+    return model, meta
+
+def export_tier(tier):
+    with open(app.MODEL_FILENAME, 'rb') as model_file:
+        model = pickle.load(model_file)
+    meta = {
+        'tier': tier,
+        'source': app.MODEL_FILENAME,
+        'source_hash': app._file_hash(app.MODEL_FILENAME),
+        'support_vectors': int(model.support_vectors_.shape[0]),
+        'gamma': float(model._gamma),
+        'exported_at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+    }
+
+    return model, meta
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Train the per-tier classifiers and save them as native model directories.')
+    parser.add_argument('-o', '--output', default=app.MODEL_FOLDER, help='model directory (default: MODEL_FOLDER, i.e. %s)' % app.MODEL_FOLDER)
+    parser.add_argument('--tiers', nargs='+', choices=list(TIER_TABLES), default=list(TIER_TABLES), help='tiers to train (default: all)')
+    parser.add_argument('--csv', help='labelled feature CSV instead of the feature tables in app.py')
+    parser.add_argument('--from-pickle', action='store_true', help='export %s for every tier instead of training' % app.MODEL_FILENAME)
+    parser.add_argument('--C', type=float, default=1.0, help='SVC regularization (default: 1.0)')
+    parser.add_argument('--gamma', default='scale', help="RBF gamma: 'scale', 'auto' or a number (default: scale)")
+    parser.add_argument('--folds', type=int, default=5, help='cross-validation folds (default: 5)')
+    parser.add_argument('--samples', type=int, help='HSV grid points for the native/sklearn agreement check (default: whole grid, 0 = skip)')
+    args = parser.parse_args(argv)
+
+    if args.gamma not in ('scale', 'auto'):
+        args.gamma = float(args.gamma)
+
+    # Tiers that are not retrained keep their entry of an earlier report
+    report_path = os.path.join(args.output, 'report.json')
+    report = {}
+    if os.path.exists(report_path):
+        with open(report_path) as report_file:
+            report = json.load(report_file)
+    for tier in args.tiers:
+        model, meta = export_tier(tier) if args.from_pickle else train_tier(tier, args)
+        model_dir = os.path.join(args.output, tier)
+        app.NativeSVC.from_sklearn(model, meta).save(model_dir)
+        meta.update(compare_models(model, model_dir, args.samples))
+        report[tier] = meta
+
+        accuracy = ''
+        if 'train_accuracy' in meta:
+            accuracy = 'train accuracy %.3f, cv accuracy %s, ' % (meta['train_accuracy'], '-' if meta['cv_accuracy'] is None else '%.3f' % meta['cv_accuracy'])
+        agreement = meta.get('grid_agreement')
+        print('%-13s -> %s: %d support vectors, %sload %.2f ms (pickle %.2f ms), predict 100k %.3f s (sklearn %.3f s)%s' % (
+              tier, model_dir, meta['support_vectors'], accuracy, 1e3 * meta['load_seconds']['native'], 1e3 * meta['load_seconds']['pickle'],
+              meta['predict_100k_seconds']['native'], meta['predict_100k_seconds']['sklearn'],
+              ', %d / %d grid points disagree' % (agreement['mismatches'], agreement['points']) if agreement else ''), file=sys.stderr)
+
+    with open(report_path, 'w') as report_file:
+        json.dump(report, report_file, indent=2)
+
+    return 1 if any(report[tier].get('grid_agreement', {}).get('mismatches') for tier in args.tiers) else 0
+
+if __name__ == '__main__':
+    sys.exit(main())